@@ -1,4 +1,4 @@
-import requests
+import httpx
 import openpyxl
 import random
 import time
@@ -8,6 +8,10 @@ import asyncio
 import re
 import tempfile
 import json
+import hashlib
+import atexit
+import contextvars
+import sqlite3
 from pathlib import Path
 from telegram import Update
 from telegram.ext import (
@@ -23,6 +27,8 @@ from openpyxl import load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from openpyxl.utils import get_column_letter
 import math
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
 
 # ================== ФЛАСК ДЛЯ RENDER ==================
 app = Flask(__name__)
@@ -99,58 +105,592 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 GRAPHHOPPER_API_KEY = os.getenv("GRAPHHOPPER_API_KEY", "2c8e643a-360f-47ab-855d-7e884ce217ad")
 ORS_API_KEY = os.getenv("ORS_API_KEY", "")  # OpenRouteService API ключ
 YANDEX_GEOCODER_API_KEY = os.getenv("YANDEX_GEOCODER_API_KEY", "")  # Яндекс.Геокодер API ключ
+# Несколько ключей через запятую: запросы распределяются между ними с учетом дневной квоты
+GRAPHHOPPER_API_KEYS = [k.strip() for k in os.getenv("GRAPHHOPPER_API_KEYS", "").split(",") if k.strip()]
+ORS_API_KEYS = [k.strip() for k in os.getenv("ORS_API_KEYS", "").split(",") if k.strip()]
+GRAPHHOPPER_API_KEYS = GRAPHHOPPER_API_KEYS or ([GRAPHHOPPER_API_KEY] if GRAPHHOPPER_API_KEY else [])
+ORS_API_KEYS = ORS_API_KEYS or ([ORS_API_KEY] if ORS_API_KEY else [])
+GRAPHHOPPER_API_KEY = GRAPHHOPPER_API_KEYS[0] if GRAPHHOPPER_API_KEYS else ""
+ORS_API_KEY = ORS_API_KEYS[0] if ORS_API_KEYS else ""
+# Дневная квота одного ключа в запросах (0 - не ограничена)
+GRAPHHOPPER_DAILY_QUOTA = int(os.getenv("GRAPHHOPPER_DAILY_QUOTA", "500"))
+ORS_DAILY_QUOTA = int(os.getenv("ORS_DAILY_QUOTA", "2000"))
 USE_ORS_FALLBACK = bool(ORS_API_KEY)
 USE_YANDEX_GEOCODER = bool(YANDEX_GEOCODER_API_KEY)
 
+# Лимиты частоты запросов к API: запросов в секунду и сколько можно отправить подряд (0 - без ограничения)
+GRAPHHOPPER_RPS = float(os.getenv("GRAPHHOPPER_RPS", "3"))
+GRAPHHOPPER_BURST = int(os.getenv("GRAPHHOPPER_BURST", "5"))
+YANDEX_RPS = float(os.getenv("YANDEX_RPS", "10"))
+YANDEX_BURST = int(os.getenv("YANDEX_BURST", "10"))
+ORS_RPS = float(os.getenv("ORS_RPS", "0.6"))
+ORS_BURST = int(os.getenv("ORS_BURST", "3"))
+
 # Фиксированные координаты для стартовой точки (Ростов-на-Дону)
 FIXED_START_COORDS = (47.261748, 39.683642)
 
+# Адреса API
+GRAPHHOPPER_GEOCODE_URL = "https://graphhopper.com/api/1/geocode"
+GRAPHHOPPER_ROUTE_URL = "https://graphhopper.com/api/1/route"
+YANDEX_GEOCODE_URL = "https://geocode-maps.yandex.ru/1.x/"
+ORS_ROUTE_URL = "https://api.openrouteservice.org/v2/directions/driving-car"
+GRAPHHOPPER_MATRIX_URL = "https://graphhopper.com/api/1/matrix"
+ORS_MATRIX_URL = "https://api.openrouteservice.org/v2/matrix/driving-car"
+
+# Режим расчета: "route" - отдельный запрос маршрута на строку,
+# "matrix" - все участки файла считаются несколькими матричными запросами
+ROUTE_MODE = os.getenv("ROUTE_MODE", "route").lower()
+# Размер блока матрицы (точек по каждой оси в одном запросе)
+MATRIX_BLOCK_SIZE = int(os.getenv("MATRIX_BLOCK_SIZE", "25"))
+
+# Максимум точек в одном запросе маршрута
+GRAPHHOPPER_MAX_POINTS = 4
+ORS_MAX_POINTS = 20
+# Больше запросов маршрута на одну строку не делается: длинная цепочка упрощается до ключевых точек
+MAX_ROUTE_REQUESTS = int(os.getenv("MAX_ROUTE_REQUESTS", "10"))
+
+# Параллельность: сколько запросов к каждому провайдеру выполняется одновременно на старте;
+# дальше лимит подстраивается сам (растет при стабильных ответах, падает на 429/503) до максимума
+PROVIDER_CONCURRENCY = {
+    "graphhopper": int(os.getenv("GRAPHHOPPER_CONCURRENCY", "4")),
+    "yandex": int(os.getenv("YANDEX_CONCURRENCY", "4")),
+    "ors": int(os.getenv("ORS_CONCURRENCY", "2")),
+}
+PROVIDER_MAX_CONCURRENCY = {
+    "graphhopper": int(os.getenv("GRAPHHOPPER_MAX_CONCURRENCY", "16")),
+    "yandex": int(os.getenv("YANDEX_MAX_CONCURRENCY", "16")),
+    "ors": int(os.getenv("ORS_MAX_CONCURRENCY", "8")),
+}
+# Во сколько раз время ответа должно превысить обычное, чтобы считаться перегрузкой
+LATENCY_SPIKE_FACTOR = float(os.getenv("LATENCY_SPIKE_FACTOR", "3"))
+# Максимальная пауза (сек) по Retry-After / X-RateLimit-Reset, даже если провайдер просит ждать дольше
+MAX_RETRY_AFTER = float(os.getenv("MAX_RETRY_AFTER", "60"))
+# Сколько строк файла обрабатывается одновременно
+ROW_CONCURRENCY = int(os.getenv("ROW_CONCURRENCY", "4"))
+# Конвейер обработки файла: сколько строк геокодируется одновременно и емкость очередей между этапами
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", "8"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "20"))
+# Сколько файлов обрабатывается одновременно (остальные ждут в очереди)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Очередь берет первым самый дешевый файл; каждые столько секунд ожидания оценка файла уменьшается вдвое
+JOB_AGING_HALF_LIFE = float(os.getenv("JOB_AGING_HALF_LIFE", "300"))
+# Бюджет времени (сек) на одну строку и на весь файл; остаток бюджета становится таймаутом запросов (0 - без ограничения)
+ROW_DEADLINE = float(os.getenv("ROW_DEADLINE", "120"))
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "3600"))
+# Автоматический выключатель: после стольких ошибок подряд провайдер пропускается
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+# На сколько секунд отключается провайдер (после паузы - пробный запрос)
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "120"))
+# Сколько секунд простаивающее соединение с провайдером держится открытым для повторного использования
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+# Сколько последних замеров времени ответа хранится для каждого провайдера
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+# Таймауты запросов: максимум для геокодирования и маршрутов/матриц (сек); по мере накопления
+# замеров таймаут становится TIMEOUT_P99_FACTOR x p99 времени ответа, но не меньше TIMEOUT_FLOOR
+GEOCODE_TIMEOUT = float(os.getenv("GEOCODE_TIMEOUT", "10"))
+ROUTE_TIMEOUT = float(os.getenv("ROUTE_TIMEOUT", "60"))
+TIMEOUT_P99_FACTOR = float(os.getenv("TIMEOUT_P99_FACTOR", "3"))
+TIMEOUT_FLOOR = float(os.getenv("TIMEOUT_FLOOR", "2"))
+
+# Гонка провайдеров: если GraphHopper отвечает дольше своего p90, параллельно запускается ORS
+ROUTE_RACE = os.getenv("ROUTE_RACE", "").lower() in ("1", "true", "yes")
+# Задержка перед запуском ORS, пока замеров времени ответа GraphHopper недостаточно (сек)
+ROUTE_HEDGE_DELAY = float(os.getenv("ROUTE_HEDGE_DELAY", "3"))
+
 # ================== КЭШИРОВАНИЕ И ЛОГИРОВАНИЕ ==================
 GEOCODE_CACHE_FILE = "geocode_cache.json"
 ROUTE_CACHE_FILE = "route_cache.json"
+# База SQLite с кэшами (старые JSON-файлы переносятся в нее при первом запуске)
+CACHE_DB_FILE = os.getenv("CACHE_DB_FILE", "cache.db")
+# Как часто (в секундах) накопленные изменения кэша пишутся в базу
+CACHE_FLUSH_INTERVAL = float(os.getenv("CACHE_FLUSH_INTERVAL", "5"))
+# Срок жизни записи кэша геокодирования (дни, 0 - бессрочно)
+GEOCODE_CACHE_TTL_DAYS = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "30"))
+# Максимум записей в кэше геокодирования (давно не использованные вытесняются, 0 - без ограничения)
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "50000"))
+# Шаг сетки (метры), к которой привязываются координаты в ключах кэша маршрутов: ответы геокодеров
+# для одного места, отличающиеся на десятки метров, дают один ключ (0 - точные координаты)
+ROUTE_CACHE_SNAP_METERS = float(os.getenv("ROUTE_CACHE_SNAP_METERS", "200"))
+# Сколько часов помнить, что провайдер не нашел адрес (повторные запросы не отправляются)
+GEOCODE_NEGATIVE_TTL_HOURS = float(os.getenv("GEOCODE_NEGATIVE_TTL_HOURS", "24"))
 ERROR_LOG = "errors.log"
 
-def load_geocode_cache():
-    """Загружает кэш геокодирования из файла"""
-    if os.path.exists(GEOCODE_CACHE_FILE):
+class CacheStore:
+    """Хранилище кэшей в SQLite (режим WAL): точечные чтения и upsert без загрузки всего файла"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def connect(self):
+        """Открывает базу (один раз) и создает таблицу кэша"""
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    " namespace TEXT NOT NULL,"
+                    " key TEXT NOT NULL,"
+                    " value TEXT NOT NULL,"
+                    " updated_at REAL NOT NULL,"
+                    " accessed_at REAL NOT NULL DEFAULT 0,"
+                    " PRIMARY KEY (namespace, key))"
+                )
+                # База, созданная до появления LRU, не имеет колонки accessed_at
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+                if "accessed_at" not in columns:
+                    conn.execute("ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+                conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)")
+                conn.commit()
+                self._conn = conn
+        return self._conn
+    
+    def get(self, namespace, key, max_age=None):
+        """Возвращает (значение, время записи) по ключу или None; записи старше max_age секунд не выдаются"""
+        conn = self.connect()
+        min_updated_at = time.time() - max_age if max_age else 0
+        with self._lock:
+            row = conn.execute(
+                "SELECT value, updated_at FROM cache WHERE namespace = ? AND key = ? AND updated_at >= ?",
+                (namespace, key, min_updated_at)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    
+    def put_many(self, namespace, items):
+        """Записывает пачку пар (ключ, значение) одной транзакцией"""
+        if not items:
+            return
+        conn = self.connect()
+        now = time.time()
+        rows = [(namespace, key, json.dumps(value, ensure_ascii=False), now, now) for key, value in items]
+        with self._lock:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO cache (namespace, key, value, updated_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, "
+                    "updated_at = excluded.updated_at, accessed_at = excluded.accessed_at",
+                    rows
+                )
+    
+    def touch_many(self, namespace, accessed):
+        """Обновляет время последнего обращения для пачки ключей {ключ: время}"""
+        if not accessed:
+            return
+        conn = self.connect()
+        rows = [(accessed_at, namespace, key) for key, accessed_at in accessed.items()]
+        with self._lock:
+            with conn:
+                conn.executemany(
+                    "UPDATE cache SET accessed_at = MAX(accessed_at, ?) WHERE namespace = ? AND key = ?", rows
+                )
+    
+    def purge_expired(self, namespace, max_age):
+        """Удаляет записи старше max_age секунд; возвращает число удаленных"""
+        conn = self.connect()
+        with self._lock:
+            with conn:
+                cursor = conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND updated_at < ?",
+                    (namespace, time.time() - max_age)
+                )
+        return cursor.rowcount
+    
+    def evict_lru(self, namespace, max_entries):
+        """Оставляет не более max_entries записей, удаляя давно не использованные; возвращает число удаленных"""
+        excess = self.count(namespace) - max_entries
+        if excess <= 0:
+            return 0
+        conn = self.connect()
+        with self._lock:
+            with conn:
+                cursor = conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                    " SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                    (namespace, namespace, excess)
+                )
+        return cursor.rowcount
+    
+    def clear(self, namespace):
+        """Удаляет все записи пространства имен"""
+        conn = self.connect()
+        with self._lock:
+            with conn:
+                conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+    
+    def count(self, namespace):
+        """Количество записей в пространстве имен"""
+        conn = self.connect()
+        with self._lock:
+            return conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (namespace,)).fetchone()[0]
+    
+    def rekey(self, namespace, make_key, version):
+        """Пересчитывает ключи пространства имен функцией make_key, если version отличается от сохраненной (смена формата ключей).
+        Записи, получившие одинаковый ключ, сливаются - остается самая свежая. Возвращает число измененных ключей"""
+        marker_key = f"{namespace}_key_version"
+        marker = self.get("meta", marker_key)
+        if marker is not None and marker[0] == version:
+            return 0
+        conn = self.connect()
+        with self._lock:
+            rows = conn.execute(
+                "SELECT key, value, updated_at, accessed_at FROM cache WHERE namespace = ?", (namespace,)
+            ).fetchall()
+            merged = {}
+            changed = 0
+            for key, value, updated_at, accessed_at in rows:
+                new_key = make_key(key)
+                if new_key != key:
+                    changed += 1
+                current = merged.get(new_key)
+                if current is None:
+                    merged[new_key] = (value, updated_at, accessed_at)
+                elif updated_at > current[1]:
+                    merged[new_key] = (value, updated_at, max(accessed_at, current[2]))
+                else:
+                    merged[new_key] = (current[0], current[1], max(accessed_at, current[2]))
+            if changed:
+                with conn:
+                    conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+                    conn.executemany(
+                        "INSERT INTO cache (namespace, key, value, updated_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                        [(namespace, key, value, updated_at, accessed_at)
+                         for key, (value, updated_at, accessed_at) in merged.items()]
+                    )
+        self.put_many("meta", [(marker_key, version)])
+        if changed:
+            print(f"🔑 Кэш {namespace}: пересчитано ключей {changed}, записей после слияния {len(merged)}")
+        return changed
+    
+    def delete_once(self, namespace, key_pattern, marker_key):
+        """Однократно удаляет записи, ключ которых подходит под шаблон LIKE (например, заведомо неверные значения)"""
+        if self.get("meta", marker_key) is not None:
+            return 0
+        conn = self.connect()
+        with self._lock:
+            with conn:
+                removed = conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key LIKE ?", (namespace, key_pattern)
+                ).rowcount
+        self.put_many("meta", [(marker_key, True)])
+        if removed:
+            print(f"🧹 Кэш {namespace}: удалено записей {key_pattern}: {removed}")
+        return removed
+    
+    def migrate_json(self, namespace, json_path):
+        """Однократно переносит старый JSON-кэш в базу; файл переименовывается в *.migrated"""
+        if not os.path.exists(json_path):
+            return 0
         try:
-            with open(GEOCODE_CACHE_FILE, 'r', encoding='utf-8') as f:
-                cache = json.load(f)
-                print(f"📂 Загружен кэш геокодирования: {len(cache)} записей")
-                return cache
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.put_many(namespace, list(data.items()))
+            os.replace(json_path, f"{json_path}.migrated")
+            print(f"📦 {json_path}: перенесено в {self.path} {len(data)} записей")
+            return len(data)
         except Exception as e:
-            print(f"⚠️ Ошибка загрузки кэша: {e}")
-    return {}
+            print(f"⚠️ Ошибка переноса {json_path} в {self.path}: {e}")
+            return 0
 
-def save_geocode_cache(cache):
-    """Сохраняет кэш геокодирования в файл"""
-    try:
-        with open(GEOCODE_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
-        print(f"💾 Кэш сохранен: {len(cache)} записей")
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения кэша: {e}")
+_cache_store = None
+_cache_store_lock = threading.Lock()
 
-def load_route_cache():
-    """Загружает кэш маршрутов из файла"""
-    if os.path.exists(ROUTE_CACHE_FILE):
+def get_cache_store():
+    """Возвращает общее хранилище кэшей; при первом открытии переносит старые JSON-файлы"""
+    global _cache_store
+    with _cache_store_lock:
+        if _cache_store is None:
+            store = CacheStore(CACHE_DB_FILE)
+            store.connect()
+            store.migrate_json("geocode", GEOCODE_CACHE_FILE)
+            store.migrate_json("route", ROUTE_CACHE_FILE)
+            # Ключи геокодирования старого формата приводятся к каноническому виду
+            for namespace in ("geocode", "geocode_miss"):
+                store.rekey(namespace, canonical_geocode_cache_key, GEOCODE_KEY_VERSION)
+            # Маршруты ORS целиком сохранялись в 1000 раз меньше настоящих (км делились на 1000)
+            store.delete_once("route", "ors_route%", "ors_route_units_km")
+            # Ключи маршрутов пересчитываются при смене шага сетки координат
+            store.rekey("route", snapped_route_cache_key, ROUTE_CACHE_SNAP_METERS)
+            _cache_store = store
+    return _cache_store
+
+class PersistentCache:
+    """Кэш поверх CacheStore: горячие записи держатся в памяти (LRU), изменения пишутся в базу пачками"""
+    
+    def __init__(self, namespace, flush_interval, ttl=None, max_entries=None):
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.dirty = {}
+        self.accessed = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._timer = None
+    
+    def _remember(self, key, value, stored_at):
+        """Кладет запись в память, вытесняя самые давние при превышении max_entries"""
+        self.data[key] = (value, stored_at)
+        self.data.move_to_end(key)
+        if self.max_entries:
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+    
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self.data.get(key)
+            if entry is not None and self.ttl and now - entry[1] > self.ttl:
+                del self.data[key]
+                entry = None
+            if entry is not None:
+                self.data.move_to_end(key)
+        
+        if entry is None:
+            entry = get_cache_store().get(self.namespace, key, max_age=self.ttl)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            # JSON возвращает координаты списком, в коде они кортежи
+            if isinstance(value, list):
+                value = tuple(value)
+            entry = (value, stored_at)
+            with self._lock:
+                self._remember(key, value, stored_at)
+        
+        with self._lock:
+            self.accessed[key] = now
+        return entry[0]
+    
+    def get(self, key):
+        """Возвращает значение из кэша и учитывает попадание/промах"""
+        value = self._lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+    
+    def peek(self, key):
+        """Есть ли живая запись - без учета в статистике и без обновления времени обращения (для оценок)"""
+        with self._lock:
+            entry = self.data.get(key)
+        if entry is not None:
+            return not (self.ttl and time.time() - entry[1] > self.ttl)
+        return get_cache_store().get(self.namespace, key, max_age=self.ttl) is not None
+    
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._remember(key, value, time.time())
+            self.dirty[key] = value
+    
+    def __len__(self):
+        return get_cache_store().count(self.namespace) + len(self.dirty)
+    
+    def clear(self):
+        """Полностью очищает кэш (в памяти и в базе)"""
+        with self._lock:
+            self.data.clear()
+            self.dirty.clear()
+            self.accessed.clear()
+        get_cache_store().clear(self.namespace)
+    
+    def purge(self):
+        """Удаляет из базы просроченные записи и вытесняет лишние по LRU"""
+        self.flush()
+        store = get_cache_store()
+        removed = 0
+        if self.ttl:
+            removed += store.purge_expired(self.namespace, self.ttl)
+        if self.max_entries:
+            removed += store.evict_lru(self.namespace, self.max_entries)
+        if removed:
+            self.evicted += removed
+            print(f"🧹 Кэш {self.namespace}: удалено устаревших записей: {removed}")
+        return removed
+    
+    def schedule_flush(self):
+        """Планирует фоновую запись; изменения за flush_interval секунд пишутся одной пачкой"""
+        with self._lock:
+            if self._timer is not None or not (self.dirty or self.accessed):
+                return
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def flush(self):
+        """Записывает накопленные изменения и время обращений в базу"""
+        with self._lock:
+            self._timer = None
+            if not (self.dirty or self.accessed):
+                return 0
+            items = list(self.dirty.items())
+            accessed = self.accessed
+            self.dirty = {}
+            self.accessed = {}
+        
         try:
-            with open(ROUTE_CACHE_FILE, 'r', encoding='utf-8') as f:
-                cache = json.load(f)
-                print(f"📂 Загружен кэш маршрутов: {len(cache)} записей")
-                return cache
+            store = get_cache_store()
+            store.put_many(self.namespace, items)
+            store.touch_many(self.namespace, accessed)
+            if self.max_entries and items:
+                self.evicted += store.evict_lru(self.namespace, self.max_entries)
+            return len(items)
         except Exception as e:
-            print(f"⚠️ Ошибка загрузки кэша маршрутов: {e}")
-    return {}
+            print(f"⚠️ Ошибка сохранения кэша ({self.namespace}): {e}")
+            with self._lock:
+                for key, value in items:
+                    self.dirty.setdefault(key, value)
+            return 0
+    
+    def stats(self):
+        """Счетчики для диагностики"""
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(hit_rate, 1),
+            "pending": len(self.dirty),
+            "evicted": self.evicted,
+        }
+
+GEOCODE_CACHE = PersistentCache(
+    "geocode", CACHE_FLUSH_INTERVAL,
+    ttl=GEOCODE_CACHE_TTL_DAYS * 24 * 3600 if GEOCODE_CACHE_TTL_DAYS > 0 else None,
+    max_entries=GEOCODE_CACHE_MAX_ENTRIES if GEOCODE_CACHE_MAX_ENTRIES > 0 else None
+)
+ROUTE_CACHE = PersistentCache("route", CACHE_FLUSH_INTERVAL)
+# Отрицательный кэш: запросы геокодирования, на которые провайдер ответил "не найдено"
+GEOCODE_MISSES = PersistentCache(
+    "geocode_miss", CACHE_FLUSH_INTERVAL,
+    ttl=GEOCODE_NEGATIVE_TTL_HOURS * 3600 if GEOCODE_NEGATIVE_TTL_HOURS > 0 else None
+)
+# Дневные счетчики использования API-ключей (хранятся двое суток)
+API_KEY_USAGE = PersistentCache("api_keys", CACHE_FLUSH_INTERVAL, ttl=2 * 86400)
+atexit.register(GEOCODE_CACHE.flush)
+atexit.register(ROUTE_CACHE.flush)
+atexit.register(GEOCODE_MISSES.flush)
+atexit.register(API_KEY_USAGE.flush)
+
+def load_geocode_cache():
+    """Возвращает общий кэш геокодирования (записи читаются из базы по мере обращения)"""
+    get_cache_store()
+    return GEOCODE_CACHE
+
+def save_geocode_cache(cache):
+    """Записывает изменения кэша геокодирования в базу"""
+    saved = cache.flush()
+    print(f"💾 Кэш сохранен: {saved} новых записей")
+
+def load_route_cache():
+    """Возвращает общий кэш маршрутов (записи читаются из базы по мере обращения)"""
+    get_cache_store()
+    return ROUTE_CACHE
 
 def save_route_cache(cache):
-    """Сохраняет кэш маршрутов в файл"""
-    try:
-        with open(ROUTE_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
-        print(f"💾 Кэш маршрутов сохранен: {len(cache)} записей")
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения кэша маршрутов: {e}")
+    """Ставит сохранение кэша маршрутов в очередь фоновой записи"""
+    cache.schedule_flush()
+
+# Неудачные запросы геокодирования текущей задачи (ключи кэша вида "провайдер_запрос")
+GEOCODE_FAILED_ATTEMPTS = contextvars.ContextVar("GEOCODE_FAILED_ATTEMPTS", default=None)
+
+def geocode_known_failure(cache_key):
+    """Запрос уже не удался в этой задаче или провайдер недавно не нашел этот адрес"""
+    attempts = GEOCODE_FAILED_ATTEMPTS.get()
+    if attempts is not None and cache_key in attempts:
+        return True
+    return cache_key in GEOCODE_MISSES
+
+def remember_geocode_failure(cache_key, not_found):
+    """Запоминает неудачу: в задаче - любую, в отрицательном кэше - только ответ "не найдено"
+    (таймауты и ошибки провайдера в следующих задачах пробуются снова)"""
+    attempts = GEOCODE_FAILED_ATTEMPTS.get()
+    if attempts is not None:
+        attempts.add(cache_key)
+    if not_found:
+        GEOCODE_MISSES[cache_key] = True
+        GEOCODE_MISSES.schedule_flush()
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные запросы: пока запрос по ключу выполняется,
+    остальные вызовы с тем же ключом ждут его результат, а не обращаются к API повторно"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = {}
+        self.waiters = {}
+        self.shared = 0
+    
+    async def run(self, key, func, *args):
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_shared(func, args))
+            self.in_flight[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda _, key=key: self._forget(key, task))
+        else:
+            self.shared += 1
+        
+        # Каждый ожидающий ограничивает ожидание своим бюджетом времени
+        deadline = REQUEST_DEADLINE.get()
+        loop = asyncio.get_running_loop()
+        wait_until = None if deadline is None else loop.time() + (deadline - time.monotonic())
+        
+        self.waiters[key] += 1
+        try:
+            async with asyncio.timeout_at(wait_until):
+                try:
+                    result, failed_attempts = await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    # Запрос отменяется, только если его результат больше никто не ждет
+                    if not task.done() and self.waiters[key] == 1:
+                        task.cancel()
+                    raise
+        except TimeoutError:
+            # Бюджет этого ожидающего исчерпан - как и при нехватке бюджета внутри запроса, результата нет
+            return None
+        finally:
+            if self.in_flight.get(key) is task:
+                self.waiters[key] -= 1
+        
+        # Неудачные попытки общего запроса запоминаются в задаче каждого ожидающего
+        attempts = GEOCODE_FAILED_ATTEMPTS.get()
+        if attempts is not None:
+            attempts.update(failed_attempts)
+        return result
+    
+    @staticmethod
+    async def _run_shared(func, args):
+        """Общий запрос идет без дедлайна и набора неудачных попыток того, кто его запустил:
+        иначе остальные ожидающие получали бы чужой бюджет и чужой набор попыток"""
+        REQUEST_DEADLINE.set(None)
+        GEOCODE_FAILED_ATTEMPTS.set(set())
+        result = await func(*args)
+        return result, GEOCODE_FAILED_ATTEMPTS.get()
+    
+    def _forget(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+            del self.waiters[key]
+
+GEOCODE_FLIGHTS = SingleFlight("geocode")
+ROUTE_FLIGHTS = SingleFlight("route")
 
 def log_error(row_num, address, error_type, details=""):
     """Логирует ошибки в файл"""
@@ -459,6 +999,90 @@ def has_forbidden_region(address):
     
     return False
 
+# Сокращения регионов и типов населенных пунктов (пустая строка - сокращение отбрасывается)
+REGION_MAPPING = {
+    'р. карелия': 'республика карелия',
+    'р. коми': 'республика коми',
+    'р. башкортостан': 'республика башкортостан',
+    'р. адыгея': 'республика адыгея',
+    'р. татарстан': 'республика татарстан',
+    'рсо-алания': 'республика северная осетия-алания',
+    'кчр': 'карачаево-черкесская республика',
+    'кбр': 'кабардино-балкарская республика',
+    'р. мордовия': 'республика мордовия',
+    'р. марий эл': 'республика марий эл',
+    'р. удмуртия': 'удмуртская республика',
+    'р. чувашия': 'чувашская республика',
+    'обл.': 'область',
+    'край.': 'край',
+    'респ.': 'республика',
+    'г.': '',
+    'с.': '',
+    'п.': '',
+    'ст-ца': '',
+    'ст.': '',
+    'х.': '',
+    'д.': '',
+    'рп.': '',
+    'пгт.': '',
+    'аул': '',
+}
+
+# Те же замены по границам слов (для ключей кэша: "с." не должно срабатывать внутри "пос.").
+# clean_text превращает точку после сокращения в запятую ("обл." -> "обл,"), поэтому ищется и такой вариант
+_REGION_MAPPING_PATTERNS = [
+    (re.compile(r'(?<![\w-])' + re.escape(variant) + (r'(?![\w-])' if variant[-1].isalnum() else '')), new)
+    for old, new in REGION_MAPPING.items()
+    for variant in dict.fromkeys((old, old.replace('.', ',')))
+]
+# Сокращения, записанные совсем без точки ("Ростовская обл", "г Шахты")
+_ABBREVIATION_TOKENS = {
+    old.rstrip('.'): new for old, new in REGION_MAPPING.items() if old.endswith('.') and ' ' not in old
+}
+_ABBREVIATION_TOKENS['р'] = 'республика'
+# Слова, не влияющие на место (страна, типы населенных пунктов без сокращения)
+ADDRESS_NOISE_TOKENS = {
+    'россия', 'russia', 'рф', 'российская', 'федерация',
+    'город', 'село', 'поселок', 'деревня',
+}
+# Версия формата ключей кэша геокодирования (при смене старые ключи пересчитываются один раз)
+GEOCODE_KEY_VERSION = 2
+
+def canonical_address_key(address):
+    """Канонический вид адреса для ключей кэша: регистр, сокращения, порядок слов,
+    запятые и ", Россия" на ключ не влияют. Работает и с адресом после clean_text.
+
+    >>> canonical_address_key("Шахты, Ростовская область")
+    'область ростовская шахты'
+    >>> canonical_address_key("ростовская обл., г. Шахты")
+    'область ростовская шахты'
+    >>> canonical_address_key("Ростовская Обл, , Г, Шахты, Россия")
+    'область ростовская шахты'
+    >>> canonical_address_key("г Шахты Ростовская обл")
+    'область ростовская шахты'
+    >>> canonical_address_key("Р, Удмуртия, Г, Ижевск") == canonical_address_key("Ижевск, Удмуртская республика")
+    True
+    """
+    text = address.lower().replace('ё', 'е')
+    for pattern, replacement in _REGION_MAPPING_PATTERNS:
+        text = pattern.sub(f' {replacement} ', text)
+    tokens = set()
+    for token in re.findall(r'\w+(?:-\w+)*', text):
+        tokens.update(_ABBREVIATION_TOKENS.get(token, token).split())
+    tokens -= ADDRESS_NOISE_TOKENS
+    return ' '.join(sorted(tokens)) or address.strip().lower()
+
+def geocode_cache_key(provider, address):
+    """Ключ кэша геокодирования: префикс провайдера ("gh", "yandex") + канонический адрес"""
+    return f"{provider}_{canonical_address_key(address)}"
+
+def canonical_geocode_cache_key(key):
+    """Пересчитывает ключ старого формата ("gh_<адрес как есть>") в канонический"""
+    provider, sep, address = key.partition('_')
+    if not sep or provider not in ("gh", "yandex"):
+        return key
+    return geocode_cache_key(provider, address)
+
 def simplify_address_for_geocoding_v2(address):
     """Упрощает адрес для геокодирования с учетом особых случаев"""
     if not address:
@@ -484,37 +1108,8 @@ def simplify_address_for_geocoding_v2(address):
         if wrong in address_lower:
             address_lower = address_lower.replace(wrong, correct)
     
-    # Расширенный список регионов для преобразования
-    region_mapping = {
-        'р. карелия': 'республика карелия',
-        'р. коми': 'республика коми',
-        'р. башкортостан': 'республика башкортостан',
-        'р. адыгея': 'республика адыгея',
-        'р. татарстан': 'республика татарстан',
-        'рсо-алания': 'республика северная осетия-алания',
-        'кчр': 'карачаево-черкесская республика',
-        'кбр': 'кабардино-балкарская республика',
-        'р. мордовия': 'республика мордовия',
-        'р. марий эл': 'республика марий эл',
-        'р. удмуртия': 'удмуртская республика',
-        'р. чувашия': 'чувашская республика',
-        'обл.': 'область',
-        'край.': 'край',
-        'респ.': 'республика',
-        'г.': '',
-        'с.': '',
-        'п.': '',
-        'ст-ца': '',
-        'ст.': '',
-        'х.': '',
-        'д.': '',
-        'рп.': '',
-        'пгт.': '',
-        'аул': '',
-    }
-    
     # Заменяем сокращения
-    for old, new in region_mapping.items():
+    for old, new in REGION_MAPPING.items():
         address_lower = address_lower.replace(old, new)
     
     # Восстанавливаем заглавные буквы
@@ -532,6 +1127,560 @@ def simplify_address_for_geocoding_v2(address):
     
     return address.strip()
 
+# ================== АСИНХРОННЫЙ HTTP-КЛИЕНТ ==================
+# Для каждого провайдера - свой пул постоянных (keep-alive) соединений, общий для всех задач.
+# Размер пула равен максимальному лимиту параллельности провайдера
+_http_clients = {}
+
+class ConnectionStats:
+    """Счетчики запросов и новых TCP-соединений провайдера (остальные запросы шли по открытым соединениям)"""
+    
+    def __init__(self, provider):
+        self.provider = provider
+        self.requests = 0
+        self.connections = 0
+    
+    async def trace(self, event_name, info):
+        """Обработчик трассировки httpcore: считает установленные соединения"""
+        if event_name == "connection.connect_tcp.complete":
+            self.connections += 1
+    
+    def status(self):
+        """Текстовое состояние для /test"""
+        reused = max(0, self.requests - self.connections)
+        share = reused / self.requests * 100 if self.requests else 0
+        return f"запросов {self.requests}, соединений {self.connections}, повторно {reused} ({share:.0f}%)"
+
+PROVIDER_CONNECTIONS = {provider: ConnectionStats(provider) for provider in PROVIDER_MAX_CONCURRENCY}
+
+def get_http_client(provider):
+    """Возвращает асинхронный HTTP-клиент провайдера (создается при первом обращении)"""
+    client = _http_clients.get(provider)
+    if client is None or client.is_closed:
+        size = PROVIDER_MAX_CONCURRENCY[provider]
+        limits = httpx.Limits(
+            max_connections=size,
+            max_keepalive_connections=size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        client = httpx.AsyncClient(limits=limits)
+        _http_clients[provider] = client
+    return client
+
+async def close_http_client():
+    """Закрывает HTTP-клиенты всех провайдеров"""
+    for client in list(_http_clients.values()):
+        if not client.is_closed:
+            await client.aclose()
+    _http_clients.clear()
+
+# Момент (time.monotonic), к которому должна завершиться текущая строка или задача
+REQUEST_DEADLINE = contextvars.ContextVar("REQUEST_DEADLINE", default=None)
+
+def set_deadline(seconds):
+    """Устанавливает дедлайн текущей задачи через seconds секунд, но не позже уже действующего"""
+    deadline = time.monotonic() + seconds
+    current = REQUEST_DEADLINE.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    REQUEST_DEADLINE.set(deadline)
+    return deadline
+
+def budget_timeout(timeout):
+    """Таймаут запроса с учетом оставшегося бюджета времени; TimeoutError, если бюджет исчерпан"""
+    deadline = REQUEST_DEADLINE.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("бюджет времени исчерпан")
+    return min(timeout, remaining)
+
+class LatencyTracker:
+    """Скользящее окно времени ответа по каждой паре (провайдер, endpoint)"""
+    
+    def __init__(self, window):
+        self.window = window
+        self.samples = {}
+    
+    def record(self, provider, endpoint, seconds):
+        samples = self.samples.get((provider, endpoint))
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self.samples[(provider, endpoint)] = samples
+        samples.append(seconds)
+    
+    def percentile(self, provider, endpoint, percent, min_samples=5):
+        """Перцентиль времени ответа в секундах; None, если замеров пока мало"""
+        samples = self.samples.get((provider, endpoint))
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(math.ceil(percent / 100 * len(ordered))) - 1)
+        return ordered[max(0, index)]
+    
+    def adaptive_timeout(self, provider, endpoint, ceiling):
+        """Таймаут запроса: TIMEOUT_P99_FACTOR x p99 в пределах [TIMEOUT_FLOOR, ceiling].
+        Пока замеров мало, используется ceiling. Запрос, оборвавшийся по таймауту, записывается
+        со временем, равным таймауту, поэтому при замедлении провайдера таймаут растет сам"""
+        p99 = self.percentile(provider, endpoint, 99, min_samples=20)
+        if p99 is None:
+            return ceiling
+        return min(ceiling, max(TIMEOUT_FLOOR, p99 * TIMEOUT_P99_FACTOR))
+    
+    def status(self, provider):
+        """Текстовое состояние для /test: p99 по каждому endpoint провайдера"""
+        parts = []
+        for (sample_provider, endpoint), samples in self.samples.items():
+            p99 = self.percentile(sample_provider, endpoint, 99, min_samples=1)
+            if sample_provider == provider and p99 is not None:
+                parts.append(f"{endpoint} p99 {p99:.1f} с ({len(samples)} замеров)")
+        return ", ".join(parts) or "нет замеров"
+
+PROVIDER_LATENCY = LatencyTracker(LATENCY_WINDOW)
+
+class TokenBucket:
+    """Ограничитель частоты запросов: в среднем rate запросов в секунду, не более burst подряд.
+    Ждут только реальные запросы к API, обращения к кэшу его не расходуют"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+    
+    def _reserve(self):
+        """Забирает токен (в долг, если их нет) и возвращает, сколько секунд нужно подождать"""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+            return wait
+    
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+PROVIDER_RATE_LIMITS = {
+    "graphhopper": TokenBucket(GRAPHHOPPER_RPS, GRAPHHOPPER_BURST),
+    "yandex": TokenBucket(YANDEX_RPS, YANDEX_BURST),
+    "ors": TokenBucket(ORS_RPS, ORS_BURST),
+}
+
+class ProviderUnavailable(Exception):
+    """Провайдер временно отключен автоматическим выключателем"""
+
+class CircuitBreaker:
+    """Автоматический выключатель провайдера: после серии ошибок или ответа о превышении квоты
+    провайдер пропускается на время cooldown, затем пробными запросами проверяется, ожил ли он"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, provider, failure_threshold, cooldown):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe = None
+        self.trips = 0
+        self.rejected = 0
+        self.last_error = ""
+    
+    def allow(self):
+        """Можно ли сейчас отправить запрос провайдеру. В полуоткрытом состоянии вместо True
+        возвращается метка пробного запроса - ее передают в record_cancel"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self.probe = None
+            print(f"🔌 {self.provider}: пробный запрос после паузы")
+        
+        if self.state == self.HALF_OPEN:
+            # В полуоткрытом состоянии пропускаем только один пробный запрос за раз
+            if self.probe is not None:
+                self.rejected += 1
+                return False
+            self.probe = object()
+            return self.probe
+        
+        return True
+    
+    def available(self):
+        """Стоит ли планировать запросы к провайдеру (без расхода пробного запроса)"""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return True
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            print(f"✅ {self.provider}: провайдер снова доступен")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe = None
+    
+    def record_failure(self, reason, trip=False):
+        """Учитывает ошибку; trip=True (429/квота) отключает провайдера сразу"""
+        self.failures += 1
+        self.last_error = reason
+        if trip or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe = None
+            self.trips += 1
+            print(f"🔌 {self.provider}: отключен на {self.cooldown:.0f} с ({reason})")
+    
+    def record_cancel(self, probe):
+        """Запрос отменен до ответа; если это был пробный запрос, пробный слот освобождается"""
+        if probe is not None and probe is self.probe:
+            self.probe = None
+    
+    def status(self):
+        """Текстовое состояние для /test"""
+        if self.state == self.OPEN:
+            remaining = max(0, self.cooldown - (time.monotonic() - self.opened_at))
+            return f"🔴 отключен ещё {remaining:.0f} с ({self.last_error[:60]})"
+        if self.state == self.HALF_OPEN:
+            return "🟡 проверка"
+        return f"🟢 работает (ошибок подряд: {self.failures})"
+
+PROVIDER_BREAKERS = {
+    provider: CircuitBreaker(provider, BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+    for provider in PROVIDER_CONCURRENCY
+}
+
+def parse_retry_after(response):
+    """Значение заголовка Retry-After в секундах (число или HTTP-дата); None, если заголовка нет"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimiter:
+    """Адаптивный лимит одновременных запросов к провайдеру (AIMD): пока ответы 200 и время
+    ответа стабильно, лимит растет на 1 за каждые limit успешных ответов; на 429/503, таймаут
+    или всплеск времени ответа лимит уменьшается вдвое. Retry-After приостанавливает отправку"""
+    
+    def __init__(self, provider, initial, minimum, maximum):
+        self.provider = provider
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.in_flight = 0
+        self.baseline = None
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.decreases = 0
+        self._waiters = deque()
+    
+    async def acquire(self):
+        """Ждет свободного слота, затем - окончания паузы Retry-After"""
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Слот уже был передан этому ожидающему - передаем его следующему
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            try:
+                # Пауза не дольше оставшегося бюджета строки или файла
+                await asyncio.sleep(budget_timeout(delay))
+            except (asyncio.CancelledError, TimeoutError):
+                self.release()
+                raise
+    
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+    
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+    
+    def on_success(self, latency):
+        """Ответ 200: аддитивный рост, если время ответа не выросло скачком"""
+        if self.baseline is not None and latency > self.baseline * LATENCY_SPIKE_FACTOR:
+            self.on_overload(f"время ответа {latency:.1f} с")
+            return
+        self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._wake()
+    
+    def on_overload(self, reason, retry_after=None):
+        """429/503, таймаут или всплеск времени ответа: мультипликативное снижение"""
+        now = time.monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + min(retry_after, MAX_RETRY_AFTER))
+        # Пачка одновременных отказов - это один сигнал перегрузки, а не несколько
+        if now - self.last_decrease < max(1.0, self.baseline or 0):
+            return
+        self.last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.minimum, self.limit / 2)
+        print(f"📉 {self.provider}: лимит параллельных запросов снижен до {int(self.limit)} ({reason})")
+    
+    def status(self):
+        """Текстовое состояние для /test"""
+        return f"лимит {int(self.limit)}, в работе {self.in_flight}, снижений {self.decreases}"
+
+PROVIDER_LIMITERS = {
+    provider: AdaptiveLimiter(provider, PROVIDER_CONCURRENCY[provider], 1, PROVIDER_MAX_CONCURRENCY[provider])
+    for provider in PROVIDER_CONCURRENCY
+}
+
+class ApiKeyPool:
+    """Несколько API-ключей провайдера: запрос уходит с ключом, у которого больше всего
+    остатка дневной квоты. Ключ, получивший ошибку квоты, выводится из ротации до конца суток.
+    Последний активный ключ не отключается - провайдера восстанавливают паузы и пробные запросы выключателя"""
+    
+    def __init__(self, provider, keys, daily_quota):
+        self.provider = provider
+        self.keys = keys
+        self.daily_quota = daily_quota
+        self.day = None
+        self.usage = {}
+        self._lock = threading.Lock()
+    
+    def _cache_key(self, key):
+        # Сами ключи в базу не пишутся, только их хэш
+        key_id = hashlib.sha256(key.encode()).hexdigest()[:12]
+        return f"{self.provider}:{key_id}:{self.day}"
+    
+    def _usage(self, key):
+        """Счетчики ключа за текущие сутки (UTC); при смене суток счетчики начинаются заново"""
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        if today != self.day:
+            self.day = today
+            self.usage = {}
+        entry = self.usage.get(key)
+        if entry is None:
+            stored = API_KEY_USAGE.get(self._cache_key(key))
+            entry = dict(stored) if stored else {"used": 0, "retired": False}
+            self.usage[key] = entry
+        return entry
+    
+    def _save(self, key, entry):
+        API_KEY_USAGE[self._cache_key(key)] = dict(entry)
+        API_KEY_USAGE.schedule_flush()
+    
+    def _remaining(self, entry):
+        if self.daily_quota:
+            return self.daily_quota - entry["used"]
+        # Без квоты нагрузка просто распределяется поровну
+        return -entry["used"]
+    
+    def select(self):
+        """Ключ с наибольшим остатком квоты; None, если все ключи выведены из ротации"""
+        with self._lock:
+            candidates = [(self._remaining(self._usage(key)), key) for key in self.keys
+                          if not self._usage(key)["retired"]]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda item: item[0])[1]
+    
+    def record(self, key, response):
+        """Учитывает запрос; если провайдер сообщает остаток квоты, счетчик подтягивается к нему"""
+        with self._lock:
+            entry = self._usage(key)
+            entry["used"] += 1
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            if self.daily_quota and remaining and remaining.isdigit():
+                entry["used"] = max(entry["used"], self.daily_quota - int(remaining))
+            self._save(key, entry)
+    
+    def retire(self, key, reason):
+        """Выводит ключ из ротации до конца суток; False, если это последний активный ключ (он остается)"""
+        with self._lock:
+            entry = self._usage(key)
+            if entry["retired"]:
+                return False
+            others = [other for other in self.keys if other != key and not self._usage(other)["retired"]]
+            if not others:
+                return False
+            entry["retired"] = True
+            self._save(key, entry)
+        print(f"🔑 {self.provider}: ключ ...{key[-4:]} отключен до конца суток ({reason})")
+        return True
+    
+    def status(self):
+        """Текстовое состояние для /test"""
+        with self._lock:
+            entries = [self._usage(key) for key in self.keys]
+        active = sum(1 for entry in entries if not entry["retired"])
+        used = sum(entry["used"] for entry in entries)
+        return f"ключей {len(self.keys)}, активных {active}, запросов за сутки {used}"
+
+API_KEY_POOLS = {
+    "graphhopper": ApiKeyPool("graphhopper", GRAPHHOPPER_API_KEYS, GRAPHHOPPER_DAILY_QUOTA),
+    "ors": ApiKeyPool("ors", ORS_API_KEYS, ORS_DAILY_QUOTA),
+}
+
+def with_api_key(provider, key, kwargs):
+    """Подставляет ключ в параметры запроса: GraphHopper - параметр key, ORS - заголовок Authorization"""
+    kwargs = dict(kwargs)
+    if provider == "graphhopper":
+        params = kwargs.get("params") or {}
+        if isinstance(params, dict):
+            kwargs["params"] = {**params, "key": key}
+        else:
+            kwargs["params"] = [(name, value) for name, value in params if name != "key"] + [("key", key)]
+    elif provider == "ors":
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), "Authorization": key}
+    return kwargs
+
+def quota_reset_after(response):
+    """Через сколько секунд провайдер снова примет запросы: Retry-After или X-RateLimit-Reset.
+    X-RateLimit-Reset бывает и числом секунд, и моментом сброса (Unix-время)"""
+    retry_after = parse_retry_after(response)
+    if retry_after is not None:
+        return retry_after
+    reset = response.headers.get("X-RateLimit-Reset")
+    try:
+        reset = float(reset) if reset else None
+    except ValueError:
+        return None
+    if reset is None:
+        return None
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+async def send_provider_request(provider, endpoint, method, url, timeout, probe=None, **kwargs):
+    """Один HTTP-запрос к провайдеру с учетом лимитов; возвращает (ответ, время ответа).
+    probe - метка, полученная от breaker.allow()"""
+    breaker = PROVIDER_BREAKERS[provider]
+    limiter = PROVIDER_LIMITERS[provider]
+    try:
+        await PROVIDER_RATE_LIMITS[provider].acquire()
+        await limiter.acquire()
+    except (asyncio.CancelledError, TimeoutError):
+        breaker.record_cancel(probe)
+        raise
+    
+    try:
+        try:
+            provider_timeout = PROVIDER_LATENCY.adaptive_timeout(provider, endpoint, timeout)
+            timeout = budget_timeout(provider_timeout)
+        except TimeoutError:
+            breaker.record_cancel(probe)
+            raise
+        started = time.monotonic()
+        try:
+            connections = PROVIDER_CONNECTIONS[provider]
+            connections.requests += 1
+            response = await get_http_client(provider).request(
+                method, url, timeout=timeout, extensions={"trace": connections.trace}, **kwargs
+            )
+        except asyncio.CancelledError:
+            breaker.record_cancel(probe)
+            raise
+        except httpx.TimeoutException as e:
+            if timeout < provider_timeout:
+                # Таймаут укорочен бюджетом строки - о провайдере он ничего не говорит
+                breaker.record_cancel(probe)
+                raise
+            # В замеры попадают только ответы и настоящие таймауты провайдера:
+            # отмененные и укороченные запросы занижали бы p99 и p90
+            PROVIDER_LATENCY.record(provider, endpoint, time.monotonic() - started)
+            limiter.on_overload("таймаут")
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            raise
+        except httpx.HTTPError as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            raise
+        latency = time.monotonic() - started
+        PROVIDER_LATENCY.record(provider, endpoint, latency)
+    finally:
+        limiter.release()
+    return response, latency
+
+async def provider_request(provider, endpoint, method, url, timeout, **kwargs):
+    """Выполняет HTTP-запрос к провайдеру, не блокируя цикл событий, и замеряет время ответа.
+    Если провайдер отключен выключателем, сразу выбрасывает ProviderUnavailable.
+    Для провайдеров с несколькими ключами ключ выбирается из пула; при ошибке квоты
+    ключ отключается до конца суток, а запрос повторяется со следующим"""
+    breaker = PROVIDER_BREAKERS[provider]
+    probe = breaker.allow()
+    if not probe:
+        raise ProviderUnavailable(f"{provider} временно отключен после ошибок")
+    
+    pool = API_KEY_POOLS.get(provider)
+    while True:
+        api_key = pool.select() if pool else None
+        if pool and pool.keys and api_key is None:
+            reason = "у всех ключей исчерпана дневная квота"
+            breaker.record_failure(reason, trip=True)
+            raise ProviderUnavailable(f"{provider}: {reason}")
+        
+        request_kwargs = with_api_key(provider, api_key, kwargs) if api_key else kwargs
+        response, latency = await send_provider_request(
+            provider, endpoint, method, url, timeout, probe=probe, **request_kwargs
+        )
+        
+        status = response.status_code
+        retry_after = quota_reset_after(response) if status in (429, 503) else None
+        # Кратковременное ограничение частоты (429 без срока сброса или со сроком не длиннее паузы
+        # выключателя) отрабатывают адаптивный лимит и выключатель; 401/403 и долгий 429 - квота ключа
+        short_limit = status == 429 and (retry_after is None or retry_after <= breaker.cooldown)
+        quota_error = status in (401, 403) or (status == 429 and not short_limit)
+        
+        if api_key:
+            pool.record(api_key, response)
+            # Запрос повторяется со следующим ключом; последний ключ не отключается
+            if quota_error and pool.retire(api_key, f"HTTP {status}"):
+                continue
+        
+        limiter = PROVIDER_LIMITERS[provider]
+        if status in (429, 503):
+            limiter.on_overload(f"HTTP {status}", retry_after)
+        elif status == 200:
+            limiter.on_success(latency)
+        
+        if short_limit:
+            breaker.record_failure(f"HTTP {status}")
+        elif quota_error:
+            breaker.record_failure(f"HTTP {status}", trip=True)
+        elif status >= 500:
+            breaker.record_failure(f"HTTP {status}")
+        else:
+            breaker.record_success()
+        return response
+
 # ================== ГЕОКОДИРОВАНИЕ ==================
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Расстояние между двумя точками по формуле гаверсинусов (в км)"""
@@ -570,91 +1719,132 @@ def validate_route_distance(distance, coordinates_list):
     
     return True
 
-def graphhopper_geocode_simple(address, cache):
-    """Простое геокодирование через GraphHopper"""
-    if not GRAPHHOPPER_API_KEY or not address:
-        return None
-    
-    # Проверяем кэш
-    cache_key = f"gh_{address}"
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    url = "https://graphhopper.com/api/1/geocode"
-    params = {
+def graphhopper_geocode_params(address):
+    """Параметры запроса геокодирования GraphHopper"""
+    return {
         "q": address,
         "key": GRAPHHOPPER_API_KEY,
         "locale": "ru",
         "limit": 1,
         "provider": "default"
     }
+
+def parse_graphhopper_geocode(data):
+    """Извлекает координаты из ответа геокодера GraphHopper"""
+    if data.get("hits") and len(data["hits"]) > 0:
+        hit = data["hits"][0]
+        point = hit.get("point", {})
+        lat = point.get("lat")
+        lng = point.get("lng")
+        
+        if lat is not None and lng is not None:
+            return (float(lat), float(lng))
+    
+    return None
+
+def yandex_geocode_params(address):
+    """Параметры запроса к Яндекс.Геокодеру"""
+    return {
+        "apikey": YANDEX_GEOCODER_API_KEY,
+        "geocode": address,
+        "format": "json",
+        "results": 1
+    }
+
+def parse_yandex_geocode(data):
+    """Извлекает координаты из ответа Яндекс.Геокодера"""
+    try:
+        pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
+        lon, lat = map(float, pos.split())
+        return (lat, lon)
+    except (KeyError, IndexError):
+        return None
+
+async def graphhopper_geocode_simple_async(address, cache):
+    """Простое геокодирование через GraphHopper (асинхронно)"""
+    if not GRAPHHOPPER_API_KEY or not address:
+        return None
+    
+    # Проверяем кэш
+    cache_key = geocode_cache_key("gh", address)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if geocode_known_failure(cache_key):
+        return None
     
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = await provider_request(
+            "graphhopper", "geocode", "GET", GRAPHHOPPER_GEOCODE_URL,
+            timeout=GEOCODE_TIMEOUT, params=graphhopper_geocode_params(address)
+        )
         
         if response.status_code == 200:
-            data = response.json()
-            if data.get("hits") and len(data["hits"]) > 0:
-                hit = data["hits"][0]
-                point = hit.get("point", {})
-                lat = point.get("lat")
-                lng = point.get("lng")
-                
-                if lat is not None and lng is not None:
-                    coords = (float(lat), float(lng))
-                    cache[cache_key] = coords
-                    return coords
+            coords = parse_graphhopper_geocode(response.json())
+            if coords:
+                cache[cache_key] = coords
+                return coords
         
+        remember_geocode_failure(cache_key, not_found=response.status_code == 200)
+        return None
+    except (ProviderUnavailable, TimeoutError) as e:
+        # Запрос не отправлялся (провайдер отключен выключателем или исчерпан бюджет) - не запоминаем
+        print(f"⚠️ Ошибка GraphHopper геокодирования: {e}")
         return None
     except Exception as e:
         print(f"⚠️ Ошибка GraphHopper геокодирования: {e}")
+        remember_geocode_failure(cache_key, not_found=False)
         return None
 
-def yandex_geocode(address, cache):
-    """Геокодирование через Яндекс.Геокодер"""
+async def yandex_geocode_async(address, cache):
+    """Геокодирование через Яндекс.Геокодер (асинхронно)"""
     if not YANDEX_GEOCODER_API_KEY or not address:
         return None
     
     # Проверяем кэш
-    cache_key = f"yandex_{address}"
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    url = "https://geocode-maps.yandex.ru/1.x/"
-    params = {
-        "apikey": YANDEX_GEOCODER_API_KEY,
-        "geocode": address,
-        "format": "json",
-        "results": 1
-    }
+    cache_key = geocode_cache_key("yandex", address)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if geocode_known_failure(cache_key):
+        return None
     
     try:
-        time.sleep(0.1)  # Пауза для соблюдения лимитов
-        response = requests.get(url, params=params, timeout=10)
+        response = await provider_request(
+            "yandex", "geocode", "GET", YANDEX_GEOCODE_URL,
+            timeout=GEOCODE_TIMEOUT, params=yandex_geocode_params(address)
+        )
         
         if response.status_code == 200:
-            data = response.json()
-            # Извлекаем координаты
-            try:
-                pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
-                lon, lat = map(float, pos.split())
-                coords = (lat, lon)
+            coords = parse_yandex_geocode(response.json())
+            if coords:
                 cache[cache_key] = coords
-                return coords
-            except (KeyError, IndexError):
-                return None
+            else:
+                remember_geocode_failure(cache_key, not_found=True)
+            return coords
         else:
             print(f"⚠️ Яндекс.Геокодер ошибка {response.status_code}")
+            remember_geocode_failure(cache_key, not_found=False)
             return None
+    except (ProviderUnavailable, TimeoutError) as e:
+        # Запрос не отправлялся (провайдер отключен выключателем или исчерпан бюджет) - не запоминаем
+        print(f"⚠️ Ошибка Яндекс.Геокодера: {e}")
+        return None
     except Exception as e:
         print(f"⚠️ Ошибка Яндекс.Геокодера: {e}")
+        remember_geocode_failure(cache_key, not_found=False)
         return None
 
-def enhanced_geocode(address, cache):
-    """Улучшенное геокодирование с несколькими стратегиями"""
+async def enhanced_geocode_async(address, cache):
+    """Улучшенное геокодирование с несколькими стратегиями (асинхронно).
+    Одновременные запросы одного и того же адреса выполняются один раз"""
     if not address:
         return None
     
+    return await GEOCODE_FLIGHTS.run(canonical_address_key(address), _enhanced_geocode_async, address, cache)
+
+async def _enhanced_geocode_async(address, cache):
+    """Геокодирование адреса без объединения запросов"""
     print(f"📍 Геокодирую: {address[:60]}...")
     
     # Упрощаем адрес
@@ -663,14 +1853,14 @@ def enhanced_geocode(address, cache):
         return None
     
     # Стратегия 1: GraphHopper
-    coords = graphhopper_geocode_simple(simplified, cache)
+    coords = await graphhopper_geocode_simple_async(simplified, cache)
     if coords:
         print(f"✅ GraphHopper нашел: {coords}")
         return coords
     
     # Стратегия 2: Яндекс (если включен)
     if USE_YANDEX_GEOCODER:
-        coords = yandex_geocode(simplified, cache)
+        coords = await yandex_geocode_async(simplified, cache)
         if coords:
             print(f"✅ Яндекс нашел: {coords}")
             return coords
@@ -679,13 +1869,13 @@ def enhanced_geocode(address, cache):
     settlement = extract_settlement_from_address(address)
     if settlement:
         simple_addr = f"{settlement}, Россия"
-        coords = graphhopper_geocode_simple(simple_addr, cache)
+        coords = await graphhopper_geocode_simple_async(simple_addr, cache)
         if coords:
             print(f"✅ GraphHopper нашел (упрощенно): {coords}")
             return coords
         
         if USE_YANDEX_GEOCODER:
-            coords = yandex_geocode(simple_addr, cache)
+            coords = await yandex_geocode_async(simple_addr, cache)
             if coords:
                 print(f"✅ Яндекс нашел (упрощенно): {coords}")
                 return coords
@@ -693,17 +1883,149 @@ def enhanced_geocode(address, cache):
     print(f"❌ Не удалось геокодировать: {address[:50]}...")
     return None
 
-def geocode_start_point(address):
-    """Специальная функция для геокодирования стартовой точки"""
-    # Всегда используем фиксированные координаты для Ростова-на-Дону
-    if "ростов-на-дону" in address.lower() or "344064" in address or "оганов" in address.lower():
-        return FIXED_START_COORDS
-    
-    return enhanced_geocode(address, load_geocode_cache())
+def is_fixed_start_point(address):
+    """Проверяет, совпадает ли стартовая точка с фиксированной (Ростов-на-Дону)"""
+    return "ростов-на-дону" in address.lower() or "344064" in address or "оганов" in address.lower()
 
 # ================== РАСЧЕТ МАРШРУТОВ ==================
-def graphhopper_route_with_waypoints(coordinates_list):
-    """Строит маршрут через промежуточные точки через GraphHopper API"""
+METERS_PER_DEGREE_LAT = 111320
+
+def snap_coordinates(lat, lon, meters):
+    """Центр ячейки сетки со стороной meters метров, в которую попадает точка"""
+    lat_step = meters / METERS_PER_DEGREE_LAT
+    snapped_lat = (math.floor(lat / lat_step) + 0.5) * lat_step
+    # Шаг по долготе растет к полюсам, чтобы ячейка оставалась примерно квадратной
+    lon_step = lat_step / max(math.cos(math.radians(snapped_lat)), 0.01)
+    snapped_lon = (math.floor(lon / lon_step) + 0.5) * lon_step
+    return snapped_lat, snapped_lon
+
+def route_cache_key(prefix, coordinates_list, snap_meters=None):
+    """Ключ кэша маршрута по списку координат.
+    Координаты привязываются к сетке ROUTE_CACHE_SNAP_METERS; шаг сетки записывается в ключ ("gh_route@200m_...")"""
+    if snap_meters is None:
+        snap_meters = ROUTE_CACHE_SNAP_METERS
+    if snap_meters <= 0:
+        coords_str = '|'.join([f"{lat:.6f},{lon:.6f}" for lat, lon in coordinates_list])
+        return f"{prefix}_route_{coords_str}"
+    snapped = [snap_coordinates(lat, lon, snap_meters) for lat, lon in coordinates_list]
+    coords_str = '|'.join([f"{lat:.6f},{lon:.6f}" for lat, lon in snapped])
+    return f"{prefix}_route@{snap_meters:g}m_{coords_str}"
+
+def snapped_route_cache_key(key):
+    """Пересчитывает ключ кэша маршрута (точный или с другим шагом сетки) под текущий ROUTE_CACHE_SNAP_METERS"""
+    match = re.fullmatch(r'(\w+?)_route(?:@[\d.]+m)?_(.+)', key)
+    if not match:
+        return key
+    try:
+        coordinates_list = [tuple(float(part) for part in point.split(',')) for point in match.group(2).split('|')]
+    except ValueError:
+        return key
+    if any(len(point) != 2 for point in coordinates_list):
+        return key
+    return route_cache_key(match.group(1), coordinates_list)
+
+def graphhopper_route_params(coordinates_list):
+    """Параметры запроса маршрута GraphHopper (точки передаются повторяющимся параметром point)"""
+    params = [("point", f"{lat},{lon}") for lat, lon in coordinates_list]
+    params += [
+        ("key", GRAPHHOPPER_API_KEY),
+        ("vehicle", "car"),
+        ("locale", "ru"),
+        ("instructions", "false"),
+        # Расстояния отдельных участков (leg_distance) считаются только вместе с точками пути
+        ("calc_points", "true"),
+        ("details", "leg_distance"),
+        ("points_encoded", "true"),
+        ("elevation", "false"),
+        ("optimize", "false"),
+    ]
+    return params
+
+def parse_graphhopper_route(data):
+    """Извлекает расстояние (км) из ответа GraphHopper"""
+    if data.get("paths") and len(data["paths"]) > 0:
+        path = data["paths"][0]
+        distance_meters = path.get("distance", 0)
+        
+        if distance_meters > 0:
+            return round(distance_meters / 1000, 1)
+        else:
+            print(f"⚠️ Нулевое расстояние в маршруте")
+            return None
+    else:
+        print(f"⚠️ Некорректный ответ от GraphHopper")
+        return None
+
+def ors_route_request(coordinates_list):
+    """Заголовки и тело запроса маршрута ORS"""
+    # ORS использует формат [долгота, широта]
+    coordinates_ors = [[lon, lat] for lat, lon in coordinates_list]
+    
+    headers = {
+        'Authorization': ORS_API_KEY,
+        'Content-Type': 'application/json'
+    }
+    
+    body = {
+        "coordinates": coordinates_ors,
+        # С инструкциями ORS возвращает segments - расстояния отдельных участков
+        "instructions": True,
+        "geometry": False,
+        "units": "km"
+    }
+    return headers, body
+
+def parse_ors_route(data):
+    """Извлекает расстояние (км) из ответа ORS"""
+    if data.get("routes") and len(data["routes"]) > 0:
+        route = data["routes"][0]
+        # Запрос отправляется с "units": "km" - расстояние уже в километрах
+        distance_km = round(route.get("summary", {}).get("distance", 0), 1)
+        
+        if distance_km > 0:
+            return distance_km
+        else:
+            print(f"⚠️ ORS нулевое расстояние в маршруте")
+            return None
+    else:
+        print(f"⚠️ Некорректный ответ от ORS")
+        return None
+
+def parse_graphhopper_legs(data):
+    """Расстояния участков между соседними точками (км) из ответа GraphHopper"""
+    try:
+        details = data["paths"][0]["details"]["leg_distance"]
+        return [value / 1000 for _, _, value in details]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+def parse_ors_legs(data):
+    """Расстояния участков между соседними точками (км) из ответа ORS"""
+    try:
+        return [segment["distance"] for segment in data["routes"][0]["segments"]]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def leg_cache_key(point_a, point_b):
+    """Ключ кэша участка A→B"""
+    return route_cache_key("leg", [point_a, point_b])
+
+def cache_route_legs(route_cache, coordinates_list, leg_distances):
+    """Сохраняет в кэш расстояния отдельных участков маршрута"""
+    if not leg_distances or len(leg_distances) != len(coordinates_list) - 1:
+        return
+    for (point_a, point_b), distance in zip(zip(coordinates_list, coordinates_list[1:]), leg_distances):
+        if distance and distance > 0:
+            route_cache[leg_cache_key(point_a, point_b)] = round(distance, 3)
+
+async def graphhopper_route_with_waypoints_async(coordinates_list):
+    """Строит маршрут через промежуточные точки через GraphHopper API (асинхронно).
+    Одновременные запросы одного и того же маршрута выполняются один раз"""
+    cache_key = route_cache_key("gh", coordinates_list)
+    return await ROUTE_FLIGHTS.run(cache_key, _graphhopper_route_with_waypoints_async, coordinates_list)
+
+async def _graphhopper_route_with_waypoints_async(coordinates_list):
+    """Запрос маршрута к GraphHopper без объединения запросов"""
     if not GRAPHHOPPER_API_KEY:
         print("⚠️ GRAPHHOPPER_API_KEY не установлен!")
         return None
@@ -711,101 +2033,57 @@ def graphhopper_route_with_waypoints(coordinates_list):
     if len(coordinates_list) < 2:
         return None
     
-    # ⚠️ GraphHopper ограничение: максимум 4 точки
-    if len(coordinates_list) > 4:
-        print(f"⚠️ GraphHopper: слишком много точек ({len(coordinates_list)}). Максимум 4.")
-        print("⚠️ Буду использовать только первые 4 точки")
-        coordinates_list = coordinates_list[:4]
-    
-    # Создаем ключ для кэша
-    coords_str = '|'.join([f"{lat:.6f},{lon:.6f}" for lat, lon in coordinates_list])
-    cache_key = f"gh_route_{coords_str}"
+    # ⚠️ GraphHopper ограничение: максимум 4 точки. Обрезанная цепочка дала бы расстояние
+    # более короткого маршрута, поэтому такой вызов отклоняется (окна нарезает compose_route_from_legs_async)
+    if len(coordinates_list) > GRAPHHOPPER_MAX_POINTS:
+        print(f"⚠️ GraphHopper: слишком много точек ({len(coordinates_list)}). Максимум {GRAPHHOPPER_MAX_POINTS}.")
+        return None
     
     # Проверяем кэш маршрутов
+    cache_key = route_cache_key("gh", coordinates_list)
     route_cache = load_route_cache()
-    if cache_key in route_cache:
-        distance = route_cache[cache_key]
+    distance = route_cache.get(cache_key)
+    if distance is not None:
         print(f"✅ Маршрут из кэша: {distance} км")
         return distance
     
-    url = "https://graphhopper.com/api/1/route"
-    
-    # Подготавливаем параметры для запроса
-    params = {
-        "key": GRAPHHOPPER_API_KEY,
-        "vehicle": "car",
-        "locale": "ru",
-        "instructions": "false",
-        "calc_points": "false",
-        "points_encoded": "false",
-        "elevation": "false",
-        "optimize": "false"
-    }
-    
-    # Добавляем точки маршрута в формате "lat,lng"
-    points = []
-    for i, coord in enumerate(coordinates_list):
-        points.append(f"point={coord[0]},{coord[1]}")
-    
-    # Формируем URL с параметрами
-    query_string = "&".join(points) + "&" + "&".join([f"{k}={v}" for k, v in params.items()])
-    
     try:
         print(f"📍 GraphHopper строит маршрут через {len(coordinates_list)} точек...")
         
-        full_url = f"{url}?{query_string}"
-        r = requests.get(full_url, timeout=60)
+        r = await provider_request(
+            "graphhopper", "route", "GET", GRAPHHOPPER_ROUTE_URL,
+            timeout=ROUTE_TIMEOUT, params=graphhopper_route_params(coordinates_list)
+        )
         
         if r.status_code != 200:
             print(f"⚠️ Ошибка маршрута {r.status_code}")
-            
-            # Если точек было 4 и ошибка 400, пробуем с 3 точками
-            if r.status_code == 400 and len(coordinates_list) == 4:
-                print("🔄 Пробую с 3 точками...")
-                # Пробуем без предпоследней точки
-                new_coords = [coordinates_list[0], coordinates_list[1], coordinates_list[3]]
-                return graphhopper_route_with_waypoints(new_coords)
-            
-            # Пробуем получить детали ошибки
-            try:
-                error_details = r.json()
-                print(f"⚠️ Детали ошибки: {error_details}")
-                if "Too many points" in str(error_details):
-                    print("🔄 Слишком много точек, пробую уменьшить...")
-                    if len(coordinates_list) > 2:
-                        return graphhopper_route_with_waypoints(coordinates_list[:len(coordinates_list)-1])
-            except:
-                print(f"⚠️ Текст ошибки: {r.text[:200]}")
+            print(f"⚠️ Детали ошибки: {r.text[:200]}")
             return None
         
         data = r.json()
-        
-        if data.get("paths") and len(data["paths"]) > 0:
-            path = data["paths"][0]
-            distance_meters = path.get("distance", 0)
+        distance_km = parse_graphhopper_route(data)
+        if distance_km:
+            print(f"✅ Маршрут построен: {distance_km} км")
             
-            if distance_meters > 0:
-                distance_km = round(distance_meters / 1000, 1)
-                print(f"✅ Маршрут построен: {distance_km} км")
-                
-                # Сохраняем в кэш
-                route_cache[cache_key] = distance_km
-                save_route_cache(route_cache)
-                
-                return distance_km
-            else:
-                print(f"⚠️ Нулевое расстояние в маршруте")
-                return None
-        else:
-            print(f"⚠️ Некорректный ответ от GraphHopper")
-            return None
+            # Сохраняем в кэш маршрут целиком и его участки
+            route_cache[cache_key] = distance_km
+            cache_route_legs(route_cache, coordinates_list, parse_graphhopper_legs(data))
+            save_route_cache(route_cache)
+        
+        return distance_km
             
     except Exception as e:
         print(f"⚠️ Ошибка при построении маршрута: {e}")
         return None
 
-def ors_route_with_waypoints(coordinates_list):
-    """Строит маршрут через OpenRouteService API (запасной вариант)"""
+async def ors_route_with_waypoints_async(coordinates_list):
+    """Строит маршрут через OpenRouteService API (асинхронно).
+    Одновременные запросы одного и того же маршрута выполняются один раз"""
+    cache_key = route_cache_key("ors", coordinates_list)
+    return await ROUTE_FLIGHTS.run(cache_key, _ors_route_with_waypoints_async, coordinates_list)
+
+async def _ors_route_with_waypoints_async(coordinates_list):
+    """Запрос маршрута к ORS без объединения запросов"""
     if not ORS_API_KEY:
         print("⚠️ ORS_API_KEY не установлен!")
         return None
@@ -813,43 +2091,28 @@ def ors_route_with_waypoints(coordinates_list):
     if len(coordinates_list) < 2:
         return None
     
-    # ORS поддерживает до 50 точек, но ограничим 20 для надежности
-    if len(coordinates_list) > 20:
-        print(f"⚠️ ORS: слишком много точек ({len(coordinates_list)}). Ограничиваю 20.")
-        coordinates_list = coordinates_list[:20]
-    
-    # Создаем ключ для кэша
-    coords_str = '|'.join([f"{lat:.6f},{lon:.6f}" for lat, lon in coordinates_list])
-    cache_key = f"ors_route_{coords_str}"
+    # ORS поддерживает до 50 точек, но ограничим 20 для надежности; длинную цепочку не обрезаем, а отклоняем
+    if len(coordinates_list) > ORS_MAX_POINTS:
+        print(f"⚠️ ORS: слишком много точек ({len(coordinates_list)}). Максимум {ORS_MAX_POINTS}.")
+        return None
     
     # Проверяем кэш маршрутов
+    cache_key = route_cache_key("ors", coordinates_list)
     route_cache = load_route_cache()
-    if cache_key in route_cache:
-        distance = route_cache[cache_key]
+    distance = route_cache.get(cache_key)
+    if distance is not None:
         print(f"✅ ORS маршрут из кэша: {distance} км")
         return distance
     
-    url = "https://api.openrouteservice.org/v2/directions/driving-car"
-    
-    # ORS использует формат [долгота, широта]
-    coordinates_ors = [[lon, lat] for lat, lon in coordinates_list]
-    
-    headers = {
-        'Authorization': ORS_API_KEY,
-        'Content-Type': 'application/json'
-    }
-    
-    body = {
-        "coordinates": coordinates_ors,
-        "instructions": False,
-        "geometry": False,
-        "units": "km"
-    }
+    headers, body = ors_route_request(coordinates_list)
     
     try:
         print(f"📍 ORS строит маршрут через {len(coordinates_list)} точек...")
         
-        r = requests.post(url, json=body, headers=headers, timeout=60)
+        r = await provider_request(
+            "ors", "route", "POST", ORS_ROUTE_URL,
+            timeout=ROUTE_TIMEOUT, json=body, headers=headers
+        )
         
         if r.status_code != 200:
             print(f"⚠️ ORS ошибка маршрута {r.status_code}")
@@ -857,104 +2120,93 @@ def ors_route_with_waypoints(coordinates_list):
             return None
         
         data = r.json()
-        
-        if data.get("routes") and len(data["routes"]) > 0:
-            route = data["routes"][0]
-            distance_km = round(route.get("summary", {}).get("distance", 0) / 1000, 1)
+        distance_km = parse_ors_route(data)
+        if distance_km:
+            print(f"✅ ORS маршрут построен: {distance_km} км")
             
-            if distance_km > 0:
-                print(f"✅ ORS маршрут построен: {distance_km} км")
-                
-                # Сохраняем в кэш
-                route_cache[cache_key] = distance_km
-                save_route_cache(route_cache)
-                
-                return distance_km
-            else:
-                print(f"⚠️ ORS нулевое расстояние в маршруте")
-                return None
-        else:
-            print(f"⚠️ Некорректный ответ от ORS")
-            return None
+            # Сохраняем в кэш маршрут целиком и его участки
+            route_cache[cache_key] = distance_km
+            cache_route_legs(route_cache, coordinates_list, parse_ors_legs(data))
+            save_route_cache(route_cache)
+        
+        return distance_km
             
     except Exception as e:
         print(f"⚠️ Ошибка при построении маршрута в ORS: {e}")
         return None
 
-def calculate_route_segments(coordinates_list):
-    """Разбивает маршрут с многими точками на сегменты по 4 точки"""
-    if len(coordinates_list) <= 4:
-        # Пробуем GraphHopper
-        distance = graphhopper_route_with_waypoints(coordinates_list)
-        if distance:
-            return distance
-        
-        # Пробуем ORS как запасной вариант
-        if USE_ORS_FALLBACK:
-            distance = ors_route_with_waypoints(coordinates_list)
-            if distance:
-                return distance
-        
-        return None
+def route_key_points(coordinates_list):
+    """Ключевые точки длинного маршрута: старт, 1/4, 1/2, 3/4, конец"""
+    key_indices = [0]
+    if len(coordinates_list) > 4:
+        key_indices.append(len(coordinates_list) // 4)
+    key_indices.append(len(coordinates_list) // 2)
+    key_indices.append(3 * len(coordinates_list) // 4)
+    key_indices.append(len(coordinates_list) - 1)
     
-    # Для маршрутов с 5-20 точками сначала пробуем ORS целиком
-    if 5 <= len(coordinates_list) <= 20 and USE_ORS_FALLBACK:
-        distance = ors_route_with_waypoints(coordinates_list)
-        if distance:
-            return distance
+    return [coordinates_list[i] for i in key_indices]
+
+class RouteSegmentError(Exception):
+    """Сегмент маршрута не удалось рассчитать"""
+
+async def sum_route_segments_async(segments, segment_func):
+    """Считает сегменты параллельно и суммирует расстояния.
+    При первой неудаче остальные сегменты отменяются и возвращается None"""
+    async def run_segment(idx, segment):
+        print(f"📍 Сегмент {idx+1}/{len(segments)}: {len(segment)} точек")
+        segment_distance = await segment_func(segment)
+        if not segment_distance:
+            print(f"⚠️ Не удалось рассчитать сегмент {idx+1}")
+            raise RouteSegmentError(idx)
+        return segment_distance
     
-    # Если ORS не сработал или точек >20, разбиваем на сегменты
-    print(f"📍 Разбиваю маршрут на сегменты ({len(coordinates_list)} точек)...")
+    failed = False
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            tasks = [task_group.create_task(run_segment(idx, segment)) for idx, segment in enumerate(segments)]
+    except* RouteSegmentError:
+        failed = True
     
-    total_distance = 0
-    segments = []
+    if failed:
+        return None
+    return sum(task.result() for task in tasks)
+
+async def compose_route_from_legs_async(coordinates_list, route_func=None, max_points=4):
+    """Собирает маршрут из участков A→B: закэшированные берутся из кэша,
+    недостающие считаются через route_func окнами не длиннее max_points точек"""
+    route_cache = load_route_cache()
+    legs = list(zip(coordinates_list, coordinates_list[1:]))
+    cached = [route_cache.get(leg_cache_key(point_a, point_b)) for point_a, point_b in legs]
+    
+    if all(cached):
+        distance = round(sum(cached), 1)
+        print(f"✅ Маршрут из кэша участков: {distance} км")
+        return distance
     
-    # Разбиваем на сегменты по 4 точки (старт + 3 промежуточные)
-    for i in range(0, len(coordinates_list)-1, 3):
-        segment = coordinates_list[i:i+4]
-        if len(segment) < 2:
+    if route_func is None:
+        return None
+    
+    # Подряд идущие недостающие участки объединяем в окна по max_points точек
+    total_distance = sum(d for d in cached if d)
+    windows = []
+    i = 0
+    while i < len(legs):
+        if cached[i]:
+            i += 1
             continue
-        
-        # Последняя точка сегмента должна быть первой следующего сегмента
-        if i > 0 and segments:
-            # Убедимся, что есть перекрытие
-            if segment[0] != segments[-1][-1]:
-                segment.insert(0, segments[-1][-1])
-        
-        segments.append(segment)
-    
-    # Если сегментов слишком много, упрощаем
-    if len(segments) > 10:
-        print(f"⚠️ Слишком много сегментов ({len(segments)}), упрощаю...")
-        # Берем только ключевые точки: старт, 1/4, 1/2, 3/4, конец
-        key_indices = [0]
-        if len(coordinates_list) > 4:
-            key_indices.append(len(coordinates_list) // 4)
-        key_indices.append(len(coordinates_list) // 2)
-        key_indices.append(3 * len(coordinates_list) // 4)
-        key_indices.append(len(coordinates_list) - 1)
-        
-        key_points = [coordinates_list[i] for i in key_indices]
-        return calculate_route_segments(key_points)
-    
-    # Рассчитываем каждый сегмент
-    for idx, segment in enumerate(segments):
-        print(f"📍 Сегмент {idx+1}/{len(segments)}: {len(segment)} точек")
-        
-        # Пробуем GraphHopper для сегмента
-        segment_distance = graphhopper_route_with_waypoints(segment)
-        
-        # Если не сработало, пробуем ORS
-        if not segment_distance and USE_ORS_FALLBACK:
-            segment_distance = ors_route_with_waypoints(segment)
-        
-        if segment_distance:
-            total_distance += segment_distance
-        else:
-            print(f"⚠️ Не удалось рассчитать сегмент {idx+1}")
-            return None
+        j = i
+        while j < len(legs) and not cached[j] and j - i < max_points - 1:
+            j += 1
+        windows.append(coordinates_list[i:j+1])
+        i = j
+    
+    print(f"📍 Участков в кэше: {len(legs) - cached.count(None)}/{len(legs)}, запросов: {len(windows)}")
+    
+    windows_distance = await sum_route_segments_async(windows, route_func)
+    if not windows_distance:
+        return None
     
-    return total_distance
+    return round(total_distance + windows_distance, 1)
 
 def validate_coordinates(coords_list):
     """Проверяет, что координаты разумные для России"""
@@ -971,8 +2223,8 @@ def validate_coordinates(coords_list):
     
     return True
 
-def calculate_route(coordinates_list):
-    """Основная функция расчета маршрута с использованием всех доступных методов"""
+def prepare_route_coordinates(coordinates_list):
+    """Проверяет координаты маршрута и удаляет дубликаты; None, если строить нечего"""
     if len(coordinates_list) < 2:
         return None
     
@@ -1000,19 +2252,90 @@ def calculate_route(coordinates_list):
         coordinates_list = unique_list
         print(f"📍 Удалены дубликаты, осталось {len(coordinates_list)} точек")
     
-    # Пробуем разные стратегии расчета
+    return coordinates_list
+
+async def race_route_async(primary, secondary, hedge_delay):
+    """Запускает primary; если за hedge_delay секунд ответа нет, параллельно запускает secondary.
+    Возвращается первое корректное расстояние, проигравший запрос отменяется"""
+    primary_task = asyncio.create_task(primary())
+    tasks = {primary_task}
+    
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        if done:
+            distance = primary_task.result() if primary_task.exception() is None else None
+            if distance and distance > 0:
+                return distance
+            # Основной провайдер уже ответил неудачей - ждать нечего
+            return await secondary()
+        
+        print(f"⏱️ Основной провайдер отвечает дольше {hedge_delay:.1f} с, запускаю запасной")
+        tasks.add(asyncio.create_task(secondary()))
+        
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result() and task.result() > 0:
+                    return task.result()
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def route_requests_needed(points, max_points):
+    """Сколько запросов нужно, чтобы покрыть цепочку из points точек окнами по max_points точек"""
+    return math.ceil((points - 1) / (max_points - 1))
+
+def plan_route_providers():
+    """Провайдеры маршрутов, к которым сейчас есть смысл обращаться, в порядке предпочтения:
+    [(название, максимум точек в запросе, функция запроса)]. Провайдеры без ключей
+    и отключенные выключателем в план не попадают"""
+    plan = []
+    for provider, max_points, route_func in ROUTE_PROVIDERS:
+        if not API_KEY_POOLS[provider].keys:
+            continue
+        if not PROVIDER_BREAKERS[provider].available():
+            print(f"⏭️ {provider} отключен выключателем, не планирую запросы к нему")
+            continue
+        plan.append((provider, max_points, route_func))
+    return plan
+
+async def calculate_route_async(coordinates_list):
+    """Основная функция расчета маршрута (асинхронно).
+    Каждый провайдер из плана вызывается не больше одного раза за строку: он запрашивает
+    только участки, которых еще нет в кэше, окнами по своему максимуму точек"""
+    coordinates_list = prepare_route_coordinates(coordinates_list)
+    if not coordinates_list:
+        return None
+    
+    providers = plan_route_providers()
+    if not providers:
+        print("❌ Нет доступных провайдеров маршрутов")
+        return None
+    
+    def provider_strategy(provider, max_points, route_func):
+        # Слишком длинную для провайдера цепочку упрощаем до ключевых точек,
+        # чтобы одна строка не стоила десятков запросов
+        points = coordinates_list
+        if route_requests_needed(len(points), max_points) > MAX_ROUTE_REQUESTS:
+            print(f"⚠️ {provider}: {len(points)} точек - слишком много запросов, упрощаю до ключевых точек")
+            points = route_key_points(points)
+        return lambda: compose_route_from_legs_async(points, route_func, max_points)
+    
     strategies = [
-        ("GraphHopper целиком", lambda: graphhopper_route_with_waypoints(coordinates_list)),
+        (f"{provider} по участкам", provider_strategy(provider, max_points, route_func))
+        for provider, max_points, route_func in providers
     ]
     
-    if USE_ORS_FALLBACK:
-        strategies.append(("ORS целиком", lambda: ors_route_with_waypoints(coordinates_list)))
-    
-    strategies.append(("Сегментарный расчет", lambda: calculate_route_segments(coordinates_list)))
+    if ROUTE_RACE and len(strategies) > 1:
+        hedge_delay = PROVIDER_LATENCY.percentile(providers[0][0], "route", 90) or ROUTE_HEDGE_DELAY
+        (primary_name, primary), (secondary_name, secondary) = strategies[:2]
+        strategies = [(f"Гонка {primary_name} / {secondary_name}",
+                       lambda: race_route_async(primary, secondary, hedge_delay))] + strategies[2:]
     
     for strategy_name, strategy_func in strategies:
         print(f"📍 Пробую стратегию: {strategy_name}")
-        distance = strategy_func()
+        distance = await strategy_func()
         if distance and distance > 0:
             print(f"✅ Успешно с стратегией: {strategy_name}")
             return distance
@@ -1020,6 +2343,12 @@ def calculate_route(coordinates_list):
     print("❌ Все стратегии расчета не сработали")
     return None
 
+# Провайдеры маршрутов в порядке предпочтения: (название, максимум точек в запросе, функция запроса)
+ROUTE_PROVIDERS = [
+    ("graphhopper", GRAPHHOPPER_MAX_POINTS, graphhopper_route_with_waypoints_async),
+    ("ors", ORS_MAX_POINTS, ors_route_with_waypoints_async),
+]
+
 def smart_variations(base_distance):
     """Умные вариации расстояний с проверкой корректности"""
     if not base_distance or base_distance <= 0:
@@ -1043,6 +2372,146 @@ def smart_variations(base_distance):
     
     return [var1, var2]
 
+# ================== МАТРИЦА РАССТОЯНИЙ ==================
+async def graphhopper_matrix_async(sources, destinations):
+    """Матрица расстояний (км) через GraphHopper Matrix API; None при ошибке"""
+    if not GRAPHHOPPER_API_KEY:
+        return None
+    
+    body = {
+        "from_points": [[lon, lat] for lat, lon in sources],
+        "to_points": [[lon, lat] for lat, lon in destinations],
+        "out_arrays": ["distances"],
+        "vehicle": "car"
+    }
+    
+    try:
+        print(f"📍 GraphHopper матрица {len(sources)}x{len(destinations)}...")
+        r = await provider_request(
+            "graphhopper", "matrix", "POST", GRAPHHOPPER_MATRIX_URL,
+            timeout=ROUTE_TIMEOUT, params={"key": GRAPHHOPPER_API_KEY}, json=body
+        )
+        
+        if r.status_code != 200:
+            print(f"⚠️ GraphHopper ошибка матрицы {r.status_code}: {r.text[:200]}")
+            return None
+        
+        distances = r.json().get("distances")
+        if not distances:
+            print(f"⚠️ Некорректный ответ матрицы от GraphHopper")
+            return None
+        
+        return [[d / 1000 if d else None for d in row] for row in distances]
+    except Exception as e:
+        print(f"⚠️ Ошибка матрицы GraphHopper: {e}")
+        return None
+
+async def ors_matrix_async(sources, destinations):
+    """Матрица расстояний (км) через ORS Matrix API; None при ошибке"""
+    if not ORS_API_KEY:
+        return None
+    
+    # ORS использует формат [долгота, широта]
+    locations = [[lon, lat] for lat, lon in sources + destinations]
+    body = {
+        "locations": locations,
+        "sources": list(range(len(sources))),
+        "destinations": list(range(len(sources), len(locations))),
+        "metrics": ["distance"],
+        "units": "km"
+    }
+    headers = {
+        'Authorization': ORS_API_KEY,
+        'Content-Type': 'application/json'
+    }
+    
+    try:
+        print(f"📍 ORS матрица {len(sources)}x{len(destinations)}...")
+        r = await provider_request(
+            "ors", "matrix", "POST", ORS_MATRIX_URL,
+            timeout=ROUTE_TIMEOUT, json=body, headers=headers
+        )
+        
+        if r.status_code != 200:
+            print(f"⚠️ ORS ошибка матрицы {r.status_code}: {r.text[:200]}")
+            return None
+        
+        distances = r.json().get("distances")
+        if not distances:
+            print(f"⚠️ Некорректный ответ матрицы от ORS")
+            return None
+        
+        return [[d if d else None for d in row] for row in distances]
+    except Exception as e:
+        print(f"⚠️ Ошибка матрицы ORS: {e}")
+        return None
+
+async def fetch_leg_distances(legs):
+    """Считает расстояния всех нужных участков (A, B) несколькими матричными запросами"""
+    # Участки, которые уже есть в кэше, не запрашиваем
+    route_cache = load_route_cache()
+    leg_distances = {}
+    for leg in legs:
+        distance = route_cache.get(leg_cache_key(*leg))
+        if distance:
+            leg_distances[leg] = distance
+    legs = set(legs) - set(leg_distances)
+    
+    points = sorted({point for leg in legs for point in leg})
+    index = {point: i for i, point in enumerate(points)}
+    block_size = max(1, MATRIX_BLOCK_SIZE)
+    blocks = [points[i:i+block_size] for i in range(0, len(points), block_size)]
+    
+    # Запрашиваем только те пары блоков, в которых есть нужные участки
+    block_pairs = {(index[a] // block_size, index[b] // block_size) for a, b in legs}
+    print(f"📍 Матрица расстояний: {len(leg_distances)} участков из кэша, "
+          f"{len(points)} точек, {len(legs)} участков, {len(block_pairs)} запросов")
+    
+    async def fetch_block(source_block, destination_block):
+        sources = blocks[source_block]
+        destinations = blocks[destination_block]
+        
+        matrix = await graphhopper_matrix_async(sources, destinations)
+        if matrix is None and USE_ORS_FALLBACK:
+            matrix = await ors_matrix_async(sources, destinations)
+        if matrix is None:
+            return
+        
+        for i, a in enumerate(sources):
+            for j, b in enumerate(destinations):
+                if (a, b) in legs and matrix[i][j]:
+                    leg_distances[(a, b)] = matrix[i][j]
+                    route_cache[leg_cache_key(a, b)] = round(matrix[i][j], 3)
+    
+    await asyncio.gather(*(fetch_block(s, d) for s, d in block_pairs))
+    save_route_cache(route_cache)
+    return leg_distances
+
+def matrix_route_distance(coordinates_list, leg_distances):
+    """Расстояние маршрута как сумма участков из матрицы; None, если какого-то участка нет"""
+    coordinates_list = prepare_route_coordinates(coordinates_list)
+    if not coordinates_list:
+        return None
+    
+    total_distance = 0
+    for leg in zip(coordinates_list, coordinates_list[1:]):
+        leg_distance = leg_distances.get(leg)
+        if not leg_distance:
+            return None
+        total_distance += leg_distance
+    
+    return round(total_distance, 1)
+
+async def route_distance_async(coordinates_list, leg_distances=None):
+    """Расстояние маршрута: из матрицы (если она посчитана), иначе запросом маршрута"""
+    if leg_distances is not None:
+        distance = matrix_route_distance(coordinates_list, leg_distances)
+        if distance:
+            print(f"✅ Маршрут из матрицы: {distance} км")
+            return distance
+    
+    return await calculate_route_async(coordinates_list)
+
 # ================== ЧТЕНИЕ И ЗАПИСЬ EXCEL ==================
 def read_excel_with_fallback(file_path):
     """Читает Excel файл с помощью openpyxl"""
@@ -1156,6 +2625,498 @@ def validate_address_chain(address_chain):
     
     return True
 
+# ================== ПЛАНИРОВАНИЕ ГЕОКОДИРОВАНИЯ ==================
+def parse_route_addresses(address_chain):
+    """Парсит цепочку адресов строки (регион берется из первого адреса цепочки)"""
+    # Извлекаем регион из первого адреса цепочки
+    first_address_region = None
+    if address_chain and '-' in address_chain:
+        first_part = address_chain.split('-')[0].strip()
+        first_address_region = extract_region_from_address_improved(first_part)
+    
+    addresses = parse_address_chain(address_chain, first_address_region)
+    
+    if not addresses:
+        # Пробуем альтернативный метод
+        addresses = extract_all_addresses_from_chain(address_chain)
+    
+    return addresses
+
+def plan_geocoding(routes):
+    """Парсит все строки заранее и собирает уникальные адреса: {упрощенный адрес: исходный адрес}"""
+    unique_addresses = {}
+    
+    for route in routes:
+        route['addresses'] = []
+        if not validate_address_chain(route['address_chain']):
+            continue
+        
+        if not is_fixed_start_point(route['start_point']):
+            key = simplify_address_for_geocoding_v2(route['start_point'])
+            if key:
+                unique_addresses.setdefault(key, route['start_point'])
+        
+        route['addresses'] = parse_route_addresses(route['address_chain'])
+        for addr in route['addresses']:
+            key = simplify_address_for_geocoding_v2(addr)
+            if key:
+                unique_addresses.setdefault(key, addr)
+    
+    return unique_addresses
+
+def count_uncached_addresses(unique_addresses, geocode_cache):
+    """Сколько уникальных адресов придется геокодировать через API (нет ни в одном кэше провайдера)"""
+    return sum(
+        1 for key in unique_addresses
+        if not geocode_cache.peek(geocode_cache_key("gh", key))
+        and not geocode_cache.peek(geocode_cache_key("yandex", key))
+    )
+
+def plan_document(routes):
+    """Разбор строк файла и оценка для очереди: (уникальные адреса, сколько из них нет в кэше)"""
+    unique_addresses = plan_geocoding(routes)
+    return unique_addresses, count_uncached_addresses(unique_addresses, load_geocode_cache())
+
+async def resolve_address(address, geocode_cache):
+    """Геокодирует адрес; если не найден, пробует только населенный пункт"""
+    coords = await enhanced_geocode_async(address, geocode_cache)
+    if coords:
+        return coords
+    
+    # Пробуем извлечь только город
+    settlement = extract_settlement_from_address(address)
+    if settlement:
+        print(f"    ⚠️ Не найден {address[:40]}, пытаюсь альтернативный метод...")
+        return await enhanced_geocode_async(f"{settlement}, Россия", geocode_cache)
+    
+    return None
+
+async def resolve_unique_addresses(unique_addresses, geocode_cache, progress_msg=None):
+    """Геокодирует каждый уникальный адрес ровно один раз (параллельно); возвращает {ключ: координаты}"""
+    resolved = {}
+    total = len(unique_addresses)
+    
+    async def resolve(key, address):
+        resolved[key] = await resolve_address(address, geocode_cache)
+        
+        if progress_msg and (len(resolved) % 10 == 0 or len(resolved) == total):
+            try:
+                await progress_msg.edit_text(f"📍 Геокодирование адресов: {len(resolved)}/{total}")
+            except Exception as e:
+                print(f"⚠️ Ошибка обновления прогресса: {e}")
+    
+    await asyncio.gather(*(resolve(key, address) for key, address in unique_addresses.items()))
+    return resolved
+
+def lookup_resolved(address, resolved):
+    """Координаты адреса из результатов геокодирования уникальных адресов"""
+    key = simplify_address_for_geocoding_v2(address)
+    if not key:
+        return None
+    return resolved.get(key)
+
+def lookup_start_point(start_point, resolved):
+    """Координаты стартовой точки (Ростов-на-Дону - фиксированные)"""
+    if is_fixed_start_point(start_point):
+        return FIXED_START_COORDS
+    return lookup_resolved(start_point, resolved)
+
+def collect_route_legs(routes, resolved):
+    """Собирает уникальные участки (A, B) всех строк, у которых геокодированы все точки"""
+    legs = set()
+    
+    for route in routes:
+        if not route['addresses']:
+            continue
+        
+        start_coords = lookup_start_point(route['start_point'], resolved)
+        points = [lookup_resolved(addr, resolved) for addr in route['addresses']]
+        if not start_coords or not all(points):
+            continue
+        
+        coordinates_list = prepare_route_coordinates([start_coords] + points)
+        if coordinates_list:
+            legs.update(zip(coordinates_list, coordinates_list[1:]))
+    
+    return legs
+
+# ================== ОБРАБОТКА СТРОК ==================
+def new_job_stats():
+    """Счетчики обработки одного файла"""
+    return {
+        "processed": 0,
+        "errors": 0,
+        "geocode_errors": 0,
+        "route_errors": 0,
+        "successful": 0,
+        "skipped": 0,
+        "timeouts": 0,
+    }
+
+def timeout_row_result():
+    """Результат строки, не уложившейся в бюджет времени"""
+    result = {0: "⏱️ Превышено время обработки"}
+    for offset in range(1, 6):
+        result[offset] = "Пропущено"
+    return result
+
+def write_row_result(ws, row_num, start_col, result):
+    """Записывает значения результата строки в лист"""
+    for offset, value in result.items():
+        ws.cell(row=row_num, column=start_col + offset).value = value
+
+async def process_route_row(route, resolved, stats, leg_distances=None):
+    """Обрабатывает одну строку файла: координаты точек и расчет маршрута.
+    Возвращает значения ячеек результата {смещение колонки: значение}"""
+    row_num = route['row_num']
+    start_point = route['start_point']
+    address_chain = route['address_chain']
+    
+    print(f"\n{'='*60}")
+    print(f"📝 Строка {row_num}")
+    print(f"🏁 Старт: {start_point[:50]}...")
+    print(f"🛣️ Маршрут: {address_chain[:50]}...")
+    
+    result = {}
+    
+    # ===== ПРОВЕРКА ДАННЫХ =====
+    if not validate_address_chain(address_chain):
+        print(f"❌ Некорректный формат адресов, пропускаю")
+        stats["skipped"] += 1
+        
+        result[0] = "❌ Некорректный формат адресов"
+        result[1] = "Пропущено"
+        result[2] = "Пропущено"
+        result[3] = 0
+        result[4] = "Ошибка"
+        result[5] = "Пропущено"
+        return result
+    
+    # ===== КООРДИНАТЫ СТАРТОВОЙ ТОЧКИ =====
+    start_coords = lookup_start_point(start_point, resolved)
+    
+    if not start_coords:
+        print(f"❌ Ошибка геокодирования старта: {start_point}")
+        stats["geocode_errors"] += 1
+        stats["errors"] += 1
+        
+        # Записываем ошибку
+        result[0] = "❌ Ошибка геокодирования старта"
+        result[1] = "Ошибка"
+        result[2] = "Ошибка"
+        result[3] = 0
+        result[4] = "Ошибка"
+        result[5] = "Ошибка"
+        return result
+    
+    # ===== ЦЕПОЧКА АДРЕСОВ (распарсена при планировании) =====
+    addresses = route['addresses']
+    
+    if not addresses:
+        print(f"⚠️ Не удалось распарсить цепочку адресов")
+        stats["errors"] += 1
+        
+        result[0] = "❌ Ошибка парсинга адресов"
+        result[1] = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
+        result[2] = "Ошибка"
+        result[3] = 0
+        result[4] = "Ошибка"
+        result[5] = "Ошибка"
+        return result
+    
+    # ===== КООРДИНАТЫ ТОЧЕК МАРШРУТА =====
+    all_coords = []
+    all_coords_str = []
+    has_geocode_error = False
+    
+    for i, addr in enumerate(addresses):
+        coords = lookup_resolved(addr, resolved)
+        
+        if coords:
+            all_coords.append(coords)
+            all_coords_str.append(f"{coords[0]:.6f},{coords[1]:.6f}")
+        else:
+            print(f"    ❌ Точка {i+1} ({addr[:40]}) не может быть геокодирована, пропускаю маршрут")
+            has_geocode_error = True
+            stats["geocode_errors"] += 1
+            break
+    
+    if has_geocode_error or not all_coords:
+        stats["errors"] += 1
+        
+        status = "❌ Ошибка геокодирования точек"
+        if not all_coords_str:
+            coordinates_str = "Ошибка"
+        else:
+            coordinates_str = "; ".join(all_coords_str)
+        
+        result[0] = status
+        result[1] = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
+        result[2] = coordinates_str
+        result[3] = len(addresses)
+        result[4] = "С промежуточными точками" if len(addresses) > 1 else "Прямой"
+        result[5] = "Ошибка"
+        return result
+    
+    # ===== РАСЧЕТ МАРШРУТА =====
+    route_type = "С промежуточными точками" if len(addresses) > 1 else "Прямой"
+    full_coordinates = [start_coords] + all_coords
+    
+    # Если точек больше 4, предупреждаем
+    if len(full_coordinates) > 4:
+        print(f"⚠️ Внимание: {len(full_coordinates)} точек в маршруте")
+        if len(full_coordinates) > 20:
+            route_type = f"{route_type} (упрощено до ключевых точек)"
+        elif len(full_coordinates) > 4:
+            route_type = f"{route_type} (сегментированный расчет)"
+    
+    print(f"📍 Строю маршрут через {len(full_coordinates)} точек...")
+    
+    distance = await route_distance_async(full_coordinates, leg_distances)
+    
+    # Проверяем корректность расстояния
+    if distance and distance > 0:
+        if not validate_route_distance(distance, full_coordinates):
+            print(f"⚠️ Подозрительное расстояние: {distance} км")
+            stats["route_errors"] += 1
+            stats["errors"] += 1
+            
+            result[0] = "⚠️ Ошибка расчета маршрута (подозрительное расстояние)"
+            result[1] = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
+            result[2] = "; ".join(all_coords_str)
+            result[3] = len(addresses)
+            result[4] = route_type
+            result[5] = "Ошибка"
+            
+            print(f"⚠️ Ошибка расчета маршрута (подозрительное расстояние)")
+        else:
+            d2, d3 = smart_variations(distance)
+            
+            # Записываем успешный результат
+            result[0] = "✅ Успешно"
+            result[1] = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
+            result[2] = "; ".join(all_coords_str)
+            result[3] = len(addresses)
+            result[4] = route_type
+            result[5] = distance
+            result[6] = d2 if d2 else ""
+            result[7] = d3 if d3 else ""
+            
+            stats["successful"] += 1
+            print(f"✅ Успешно: {distance} км")
+    else:
+        stats["route_errors"] += 1
+        stats["errors"] += 1
+        
+        status = "⚠️ Ошибка расчета маршрута"
+        if len(full_coordinates) > 20:
+            status = "⚠️ Слишком много точек (>20)"
+        elif len(full_coordinates) > 4:
+            status = "⚠️ Слишком много точек (>4)"
+        
+        result[0] = status
+        result[1] = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
+        result[2] = "; ".join(all_coords_str)
+        result[3] = len(addresses)
+        result[4] = route_type
+        result[5] = "Ошибка"
+        
+        print(f"⚠️ Ошибка расчета маршрута")
+    
+    return result
+
+async def update_progress(progress_msg, stats, total, start_point):
+    """Обновляет сообщение с прогрессом обработки"""
+    try:
+        processed = stats["processed"]
+        progress_percent = int((processed / total) * 100)
+        
+        progress_text = (
+            f"⏳ Обработка: {processed}/{total} ({progress_percent}%)\n"
+            f"✅ Успешно: {stats['successful']}\n"
+            f"❌ Ошибки: {stats['errors']}\n"
+            f"⏭️ Пропущено: {stats['skipped']}\n"
+        )
+        
+        if stats["geocode_errors"] > 0:
+            progress_text += f"📍 Геокодирование: {stats['geocode_errors']}\n"
+        
+        if stats["route_errors"] > 0:
+            progress_text += f"🛣️ Маршруты: {stats['route_errors']}\n"
+        
+        if stats["timeouts"] > 0:
+            progress_text += f"⏱️ Превышено время: {stats['timeouts']}\n"
+        
+        # Показываем текущий обрабатываемый город
+        if processed < total and stats["successful"] > 0:
+            settlement = extract_settlement_from_address(start_point)
+            if settlement:
+                progress_text += f"📍 Текущий: {settlement[:30]}..."
+        
+        await progress_msg.edit_text(progress_text)
+    except Exception as e:
+        print(f"⚠️ Ошибка обновления прогресса: {e}")
+
+class JobPipeline:
+    """Конвейер обработки файла: разбор → геокодирование → маршрут → запись.
+    Этапы связаны ограниченными очередями, поэтому геокодирование следующих строк идет
+    одновременно с расчетом маршрутов текущих, а запись в лист - строго по порядку строк"""
+    
+    def __init__(self, routes, ws, start_col, geocode_cache, stats, progress_msg, resolved=None, leg_distances=None):
+        self.routes = routes
+        self.ws = ws
+        self.start_col = start_col
+        self.geocode_cache = geocode_cache
+        self.stats = stats
+        self.progress_msg = progress_msg
+        self.resolved = resolved if resolved is not None else {}
+        self.leg_distances = leg_distances
+        self.resolving = {}
+        self.geocode_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.route_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.write_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        self.reorder = {}
+        self.peak = {"geocode": 0, "route": 0, "write": 0, "reorder": 0}
+    
+    async def _put(self, name, queue, item):
+        await queue.put(item)
+        self.peak[name] = max(self.peak[name], queue.qsize())
+    
+    async def run(self):
+        ACTIVE_PIPELINES.add(self)
+        try:
+            async with asyncio.TaskGroup() as group:
+                group.create_task(self._parse())
+                geocoders = [group.create_task(self._geocode()) for _ in range(max(1, GEOCODE_WORKERS))]
+                routers = [group.create_task(self._route()) for _ in range(max(1, ROW_CONCURRENCY))]
+                writer = group.create_task(self._write())
+                
+                await asyncio.gather(*geocoders)
+                for _ in routers:
+                    await self.route_queue.put(None)
+                await asyncio.gather(*routers)
+                await self.write_queue.put(None)
+                await writer
+        finally:
+            ACTIVE_PIPELINES.discard(self)
+        print(f"📊 Конвейер: пиковая глубина очередей {self.peak}")
+    
+    async def _parse(self):
+        """Этап разбора: строки распарсены при планировании, здесь они подаются в конвейер по порядку"""
+        for index, route in enumerate(self.routes):
+            await self._put("geocode", self.geocode_queue, (index, route))
+        for _ in range(max(1, GEOCODE_WORKERS)):
+            await self.geocode_queue.put(None)
+    
+    async def _geocode(self):
+        while (item := await self.geocode_queue.get()) is not None:
+            index, route = item
+            if validate_address_chain(route['address_chain']):
+                addresses = list(route['addresses'])
+                if not is_fixed_start_point(route['start_point']):
+                    addresses.append(route['start_point'])
+                await asyncio.gather(*(self._resolve(address) for address in addresses))
+            await self._put("route", self.route_queue, item)
+    
+    async def _resolve(self, address):
+        """Геокодирует адрес один раз за файл; остальные строки с тем же адресом ждут результат"""
+        key = simplify_address_for_geocoding_v2(address)
+        if not key or key in self.resolved:
+            return
+        future = self.resolving.get(key)
+        if future is not None:
+            await future
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.resolving[key] = future
+        try:
+            coords = await resolve_address(address, self.geocode_cache)
+        except Exception as e:
+            print(f"⚠️ Ошибка геокодирования {address[:40]}: {e}")
+            coords = None
+        self.resolved[key] = coords
+        future.set_result(coords)
+    
+    async def _route(self):
+        while (item := await self.route_queue.get()) is not None:
+            index, route = item
+            values = await self._process_row(route)
+            await self._put("write", self.write_queue, (index, route, values))
+    
+    async def _process_row(self, route):
+        # Бюджет строки отсчитывается с момента ее запуска и не выходит за бюджет файла
+        job_deadline = REQUEST_DEADLINE.get()
+        deadline = set_deadline(ROW_DEADLINE) if ROW_DEADLINE else job_deadline
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await process_route_row(route, self.resolved, self.stats, self.leg_distances)
+        except TimeoutError:
+            print(f"⏱️ Строка {route['row_num']}: превышено время обработки")
+            log_error(route['row_num'], f"{route['start_point'][:50]}...", "TIMEOUT")
+            self.stats["timeouts"] += 1
+            self.stats["errors"] += 1
+            return timeout_row_result()
+        except Exception as e:
+            print(f"❌ Критическая ошибка в строке {route['row_num']}: {e}")
+            log_error(route['row_num'], f"{route['start_point'][:50]}...", "CRITICAL", str(e))
+            self.stats["errors"] += 1
+            return {}
+        finally:
+            # Воркер обрабатывает строки по очереди: дедлайн строки не должен достаться следующей
+            REQUEST_DEADLINE.set(job_deadline)
+    
+    async def _write(self):
+        """Этап записи: результаты пишутся в лист в порядке строк файла"""
+        total = len(self.routes)
+        next_index = 0
+        while (item := await self.write_queue.get()) is not None:
+            index, route, values = item
+            self.reorder[index] = (route, values)
+            self.peak["reorder"] = max(self.peak["reorder"], len(self.reorder))
+            
+            while next_index in self.reorder:
+                route, values = self.reorder.pop(next_index)
+                write_row_result(self.ws, route['row_num'], self.start_col, values)
+                next_index += 1
+                self.stats["processed"] += 1
+                
+                # ===== ОБНОВЛЕНИЕ ПРОГРЕССА =====
+                if self.stats["processed"] % 2 == 0 or self.stats["processed"] == total:
+                    await update_progress(self.progress_msg, self.stats, total, route['start_point'])
+    
+    def status(self):
+        """Глубина очередей для /test"""
+        return (f"разбор→геокодирование {self.geocode_queue.qsize()}/{PIPELINE_QUEUE_SIZE}, "
+                f"геокодирование→маршруты {self.route_queue.qsize()}/{PIPELINE_QUEUE_SIZE}, "
+                f"маршруты→запись {self.write_queue.qsize()}/{PIPELINE_QUEUE_SIZE}, "
+                f"ждут записи по порядку {len(self.reorder)}")
+
+ACTIVE_PIPELINES = set()
+
+async def process_job_rows(routes, ws, start_col, unique_addresses, geocode_cache, stats, progress_msg):
+    """Геокодирует адреса и обрабатывает все строки файла конвейером (в пределах JOB_DEADLINE)"""
+    if JOB_DEADLINE:
+        set_deadline(JOB_DEADLINE)
+    # Неудачный запрос к провайдеру в пределах файла не повторяется
+    GEOCODE_FAILED_ATTEMPTS.set(set())
+    
+    resolved = None
+    leg_distances = None
+    if ROUTE_MODE == "matrix":
+        # Матрице нужны координаты всех точек сразу: геокодируем все уникальные адреса заранее
+        resolved = await resolve_unique_addresses(unique_addresses, geocode_cache, progress_msg)
+        
+        legs = collect_route_legs(routes, resolved)
+        try:
+            await progress_msg.edit_text(f"📍 Матрица расстояний: {len(legs)} участков...")
+        except Exception as e:
+            print(f"⚠️ Ошибка обновления прогресса: {e}")
+        leg_distances = await fetch_leg_distances(legs)
+        print(f"✅ Из матрицы получено {len(leg_distances)}/{len(legs)} участков")
+    
+    pipeline = JobPipeline(routes, ws, start_col, geocode_cache, stats, progress_msg, resolved, leg_distances)
+    await pipeline.run()
+
 # ================== TELEGRAM БОТ ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -1178,6 +3139,125 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Маленькие населенные пункты могут не найтись"
     )
 
+# ================== ОЧЕРЕДЬ ЗАДАЧ ==================
+class DocumentJob:
+    """Прочитанный файл, ожидающий обработки"""
+    
+    def __init__(self, message, user_id, file_name, input_file, routes, wb, ws, unique_addresses, cost):
+        self.message = message
+        self.user_id = user_id
+        self.file_name = file_name
+        self.input_file = input_file
+        self.routes = routes
+        self.wb = wb
+        self.ws = ws
+        self.unique_addresses = unique_addresses
+        self.cost = cost
+        self.created_at = time.time()
+        self.timestamp = int(self.created_at)
+        self.task = None
+        self.cancel_requested = False
+    
+    def cancel(self):
+        """Отменяет обработку: текущие запросы к провайдерам прерываются, новые строки не запускаются"""
+        self.cancel_requested = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+class JobQueue:
+    """Очередь файлов на обработку и пул воркеров: обработчик Telegram только ставит файл
+    в очередь и сразу освобождается, файлы обрабатываются воркерами в фоне.
+    Первым берется самый дешевый файл; ожидание снижает оценку стоимости (старение),
+    поэтому большие файлы не ждут бесконечно"""
+    
+    def __init__(self, workers, aging_half_life):
+        self.workers = max(1, workers)
+        self.aging_half_life = aging_half_life
+        self.pending = []
+        self.running = []
+        self.ready = None
+        self.tasks = []
+        self.active = 0
+        self.completed = 0
+    
+    def start(self):
+        """Запускает воркеров (один раз, внутри работающего цикла событий)"""
+        if self.tasks:
+            return
+        self.ready = asyncio.Condition()
+        self.tasks = [asyncio.create_task(self._worker(number + 1)) for number in range(self.workers)]
+        print(f"👷 Запущено воркеров обработки файлов: {self.workers}")
+    
+    def priority(self, job, now):
+        """Текущая оценка стоимости: каждые aging_half_life секунд ожидания уменьшают ее вдвое"""
+        waited = now - job.created_at
+        if not self.aging_half_life:
+            return job.cost
+        return job.cost / 2 ** (waited / self.aging_half_life)
+    
+    def next_position(self, job):
+        """Место в очереди, которое займет задача (0 - обработка начнется сразу)"""
+        if self.active + len(self.pending) < self.workers:
+            return 0
+        now = time.time()
+        job_priority = self.priority(job, now)
+        return 1 + sum(1 for other in self.pending if self.priority(other, now) <= job_priority)
+    
+    async def submit(self, job):
+        """Ставит задачу в очередь"""
+        self.start()
+        async with self.ready:
+            self.pending.append(job)
+            self.ready.notify()
+    
+    async def _next_job(self):
+        async with self.ready:
+            await self.ready.wait_for(lambda: self.pending)
+            now = time.time()
+            job = min(self.pending, key=lambda pending_job: self.priority(pending_job, now))
+            self.pending.remove(job)
+            self.active += 1
+            self.running.append(job)
+            return job
+    
+    async def cancel(self, user_id):
+        """Отменяет файлы пользователя: в работе - прерывает, из очереди - убирает.
+        Возвращает (прервано, убрано из очереди)"""
+        self.start()
+        async with self.ready:
+            removed = [job for job in self.pending if job.user_id == user_id]
+            self.pending = [job for job in self.pending if job.user_id != user_id]
+        for job in removed:
+            if os.path.exists(job.input_file):
+                os.remove(job.input_file)
+        
+        running = [job for job in self.running if job.user_id == user_id and not job.cancel_requested]
+        for job in running:
+            job.cancel()
+        return len(running), len(removed)
+    
+    async def _worker(self, number):
+        while True:
+            job = await self._next_job()
+            waited = time.time() - job.created_at
+            print(f"👷 Воркер {number}: {job.file_name} от {job.user_id}, "
+                  f"стоимость {job.cost} (в очереди {waited:.0f} с)")
+            try:
+                await process_document(job)
+            except Exception as e:
+                print(f"⚠️ Воркер {number}: ошибка обработки {job.file_name}: {e}")
+            finally:
+                self.active -= 1
+                self.completed += 1
+                self.running.remove(job)
+    
+    def status(self):
+        """Текстовое состояние для /test"""
+        return (f"воркеров {self.workers}, в работе {self.active}, "
+                f"в очереди {len(self.pending)}, выполнено {self.completed}")
+
+JOB_QUEUE = JobQueue(JOB_WORKERS, JOB_AGING_HALF_LIFE)
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик загруженных документов"""
     if not update.message or not update.message.document:
@@ -1203,7 +3283,6 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Скачиваем файл
         file = await update.message.document.get_file()
         user_id = update.message.from_user.id
-        timestamp = int(time.time())
         
         # Создаем временный файл
         with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp_file:
@@ -1218,11 +3297,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             os.remove(input_file)
             return
         
-        await update.message.reply_text(f"📥 Файл получен: {file_name}")
-        
         # Читаем данные из Excel
         try:
-            routes, wb, ws = read_excel_with_fallback(input_file)
+            # Чтение файла и разбор строк идут в потоке, чтобы не останавливать бота для остальных пользователей
+            routes, wb, ws = await asyncio.to_thread(read_excel_with_fallback, input_file)
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка чтения файла: {str(e)[:200]}\n\n"
                                            "Убедитесь, что:\n"
@@ -1249,286 +3327,107 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 os.remove(input_file)
             return
         
+        # Парсим все строки заранее и собираем уникальные адреса
+        unique_addresses, uncached = await asyncio.to_thread(plan_document, routes)
+        print(f"🔎 {len(unique_addresses)} уникальных адресов для {total} строк (не в кэше: {uncached})")
+        
+        # Ставим файл в очередь и сразу освобождаем обработчик;
+        # оценка стоимости для очереди: строки x адреса, которых нет в кэше
+        cost = total * max(1, uncached)
+        job = DocumentJob(update.message, user_id, file_name, input_file, routes, wb, ws, unique_addresses, cost)
+        position = JOB_QUEUE.next_position(job)
+        if position:
+            await update.message.reply_text(
+                f"📥 Файл получен: {file_name}\n"
+                f"🕒 Место в очереди: {position}\n"
+                f"Бот продолжает отвечать на команды, результат придет отдельным сообщением."
+            )
+        else:
+            await update.message.reply_text(f"📥 Файл получен: {file_name}")
+        await JOB_QUEUE.submit(job)
+        
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка загрузки файла: {str(e)[:200]}")
+
+async def process_document(job):
+    """Обрабатывает файл из очереди: геокодирование, маршруты, отправка результата"""
+    message = job.message
+    file_name = job.file_name
+    input_file = job.input_file
+    user_id = job.user_id
+    timestamp = job.timestamp
+    routes, wb, ws = job.routes, job.wb, job.ws
+    unique_addresses = job.unique_addresses
+    total = len(routes)
+    
+    try:
         # Отправляем начальное сообщение
-        progress_msg = await update.message.reply_text(
+        progress_msg = await message.reply_text(
             f"⏳ Начинаю обработку...\n"
             f"📊 Всего строк: {total}\n"
+            f"🔎 {len(unique_addresses)} уникальных адресов для {total} строк\n"
             f"🔑 API: GraphHopper{' + Яндекс' if USE_YANDEX_GEOCODER else ''}{' + ORS' if USE_ORS_FALLBACK else ''}\n"
             f"⏱️ Ориентировочное время: {total * 3} секунд\n\n"
             f"⚠️ **Внимание:**\n"
             f"• GraphHopper: максимум 4 точки\n"
             f"• ORS: до 20 точек (запасной вариант)\n"
             f"• Крым, ДНР, ЛНР пропускаются\n"
-            f"• Паузы между запросами для API"
+            f"• Частота запросов к API ограничена"
         )
         
-        # Очищаем старый кэш перед началом обработки
-        print("🧹 Очищаю старый кэш...")
-        if os.path.exists(GEOCODE_CACHE_FILE):
-            try:
-                os.remove(GEOCODE_CACHE_FILE)
-                print("✅ Старый кэш удален")
-            except:
-                print("⚠️ Не удалось удалить старый кэш")
-        
-        # Загружаем кэш геокодирования
+        # Загружаем кэш геокодирования и удаляем из него устаревшие записи
         geocode_cache = load_geocode_cache()
+        try:
+            geocode_cache.purge()
+            GEOCODE_MISSES.purge()
+        except Exception as e:
+            print(f"⚠️ Не удалось очистить устаревшие записи кэша: {e}")
         
         # Добавляем колонки для результатов
         start_col = add_result_columns(ws, start_col=3)
         
-        # Настройки для обработки
-        processed = 0
-        errors = 0
-        geocode_errors = 0
-        route_errors = 0
-        successful = 0
-        skipped = 0
+        # Геокодирование и расчет маршрутов идут отдельной задачей, чтобы /cancel мог их прервать
+        stats = new_job_stats()
+        job.task = asyncio.create_task(
+            process_job_rows(routes, ws, start_col, unique_addresses, geocode_cache, stats, progress_msg)
+        )
+        # /cancel мог прийти, пока задачи еще не было (отправка сообщения, очистка кэша)
+        if job.cancel_requested:
+            job.task.cancel()
+        cancelled = False
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            if not job.cancel_requested:
+                raise
+            cancelled = True
+            print(f"⛔ Обработка {file_name} отменена пользователем {user_id}: "
+                  f"обработано {stats['processed']} из {total} строк")
         
-        # Обрабатываем каждую строку
-        for route in routes:
-            try:
-                row_num = route['row_num']
-                start_point = route['start_point']
-                address_chain = route['address_chain']
-                
-                print(f"\n{'='*60}")
-                print(f"📝 Строка {row_num}/{total}")
-                print(f"🏁 Старт: {start_point[:50]}...")
-                print(f"🛣️ Маршрут: {address_chain[:50]}...")
-                
-                # ===== ПРОВЕРКА ДАННЫХ =====
-                if not validate_address_chain(address_chain):
-                    print(f"❌ Некорректный формат адресов, пропускаю")
-                    skipped += 1
-                    
-                    ws.cell(row=row_num, column=start_col).value = "❌ Некорректный формат адресов"
-                    ws.cell(row=row_num, column=start_col+1).value = "Пропущено"
-                    ws.cell(row=row_num, column=start_col+2).value = "Пропущено"
-                    ws.cell(row=row_num, column=start_col+3).value = 0
-                    ws.cell(row=row_num, column=start_col+4).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+5).value = "Пропущено"
-                    
-                    processed += 1
-                    continue
-                
-                # ===== ГЕОКОДИРОВАНИЕ СТАРТОВОЙ ТОЧКИ =====
-                print(f"📍 Геокодирую стартовую точку...")
-                start_coords = geocode_start_point(start_point)
-                
-                if not start_coords:
-                    print(f"❌ Ошибка геокодирования старта: {start_point}")
-                    geocode_errors += 1
-                    errors += 1
-                    
-                    # Записываем ошибку
-                    ws.cell(row=row_num, column=start_col).value = "❌ Ошибка геокодирования старта"
-                    ws.cell(row=row_num, column=start_col+1).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+2).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+3).value = 0
-                    ws.cell(row=row_num, column=start_col+4).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+5).value = "Ошибка"
-                    
-                    processed += 1
-                    continue
-                
-                # ===== ПАРСИНГ ЦЕПОЧКИ АДРЕСОВ =====
-                print(f"📍 Парсинг цепочки адресов...")
-                # Извлекаем регион из первого адреса цепочки
-                first_address_region = None
-                if address_chain and '-' in address_chain:
-                    first_part = address_chain.split('-')[0].strip()
-                    first_address_region = extract_region_from_address_improved(first_part)
-                
-                addresses = parse_address_chain(address_chain, first_address_region)
-                
-                if not addresses:
-                    # Пробуем альтернативный метод
-                    addresses = extract_all_addresses_from_chain(address_chain)
-                
-                if not addresses:
-                    print(f"⚠️ Не удалось распарсить цепочку адресов")
-                    errors += 1
-                    
-                    ws.cell(row=row_num, column=start_col).value = "❌ Ошибка парсинга адресов"
-                    ws.cell(row=row_num, column=start_col+1).value = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
-                    ws.cell(row=row_num, column=start_col+2).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+3).value = 0
-                    ws.cell(row=row_num, column=start_col+4).value = "Ошибка"
-                    ws.cell(row=row_num, column=start_col+5).value = "Ошибка"
-                    
-                    processed += 1
-                    continue
-                
-                # ===== ГЕОКОДИРОВАНИЕ ТОЧЕК МАРШРУТА =====
-                print(f"📍 Геокодирую точки маршрута ({len(addresses)} точек)...")
-                all_coords = []
-                all_coords_str = []
-                has_geocode_error = False
-                
-                for i, addr in enumerate(addresses):
-                    print(f"  📍 Точка {i+1}/{len(addresses)}: {addr[:40]}...")
-                    coords = enhanced_geocode(addr, geocode_cache)
-                    time.sleep(0.3)  # Пауза между запросами
-                    
-                    if coords:
-                        all_coords.append(coords)
-                        all_coords_str.append(f"{coords[0]:.6f},{coords[1]:.6f}")
-                        print(f"    ✅ Координаты: {coords}")
-                    else:
-                        print(f"    ⚠️ Точка {i+1} не найдена, пытаюсь альтернативный метод...")
-                        
-                        # Пробуем извлечь только город
-                        settlement = extract_settlement_from_address(addr)
-                        if settlement:
-                            simple_addr = f"{settlement}, Россия"
-                            coords = enhanced_geocode(simple_addr, geocode_cache)
-                        
-                        if coords:
-                            all_coords.append(coords)
-                            all_coords_str.append(f"{coords[0]:.6f},{coords[1]:.6f}")
-                            print(f"    ✅ Координаты через упрощение: {coords}")
-                        else:
-                            print(f"    ❌ Точка {i+1} не может быть геокодирована, пропускаю маршрут")
-                            has_geocode_error = True
-                            geocode_errors += 1
-                            break
-                
-                if has_geocode_error or not all_coords:
-                    errors += 1
-                    
-                    status = "❌ Ошибка геокодирования точек"
-                    if not all_coords_str:
-                        coordinates_str = "Ошибка"
-                    else:
-                        coordinates_str = "; ".join(all_coords_str)
-                    
-                    ws.cell(row=row_num, column=start_col).value = status
-                    ws.cell(row=row_num, column=start_col+1).value = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
-                    ws.cell(row=row_num, column=start_col+2).value = coordinates_str
-                    ws.cell(row=row_num, column=start_col+3).value = len(addresses)
-                    ws.cell(row=row_num, column=start_col+4).value = "С промежуточными точками" if len(addresses) > 1 else "Прямой"
-                    ws.cell(row=row_num, column=start_col+5).value = "Ошибка"
-                    
-                    processed += 1
-                    continue
-                
-                # ===== РАСЧЕТ МАРШРУТА =====
-                route_type = "С промежуточными точками" if len(addresses) > 1 else "Прямой"
-                full_coordinates = [start_coords] + all_coords
-                
-                # Если точек больше 4, предупреждаем
-                if len(full_coordinates) > 4:
-                    print(f"⚠️ Внимание: {len(full_coordinates)} точек в маршруте")
-                    if len(full_coordinates) > 20:
-                        route_type = f"{route_type} (упрощено до ключевых точек)"
-                    elif len(full_coordinates) > 4:
-                        route_type = f"{route_type} (сегментированный расчет)"
-                
-                print(f"📍 Строю маршрут через {len(full_coordinates)} точек...")
-                
-                distance = calculate_route(full_coordinates)
-                time.sleep(0.5)  # Пауза для API
-                
-                # Проверяем корректность расстояния
-                if distance and distance > 0:
-                    if not validate_route_distance(distance, full_coordinates):
-                        print(f"⚠️ Подозрительное расстояние: {distance} км")
-                        route_errors += 1
-                        errors += 1
-                        
-                        ws.cell(row=row_num, column=start_col).value = "⚠️ Ошибка расчета маршрута (подозрительное расстояние)"
-                        ws.cell(row=row_num, column=start_col+1).value = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
-                        ws.cell(row=row_num, column=start_col+2).value = "; ".join(all_coords_str)
-                        ws.cell(row=row_num, column=start_col+3).value = len(addresses)
-                        ws.cell(row=row_num, column=start_col+4).value = route_type
-                        ws.cell(row=row_num, column=start_col+5).value = "Ошибка"
-                        
-                        print(f"⚠️ Ошибка расчета маршрута (подозрительное расстояние)")
-                    else:
-                        d2, d3 = smart_variations(distance)
-                        
-                        # Записываем успешный результат
-                        ws.cell(row=row_num, column=start_col).value = "✅ Успешно"
-                        ws.cell(row=row_num, column=start_col+1).value = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
-                        ws.cell(row=row_num, column=start_col+2).value = "; ".join(all_coords_str)
-                        ws.cell(row=row_num, column=start_col+3).value = len(addresses)
-                        ws.cell(row=row_num, column=start_col+4).value = route_type
-                        ws.cell(row=row_num, column=start_col+5).value = distance
-                        ws.cell(row=row_num, column=start_col+6).value = d2 if d2 else ""
-                        ws.cell(row=row_num, column=start_col+7).value = d3 if d3 else ""
-                        
-                        successful += 1
-                        print(f"✅ Успешно: {distance} км")
-                else:
-                    route_errors += 1
-                    errors += 1
-                    
-                    status = "⚠️ Ошибка расчета маршрута"
-                    if len(full_coordinates) > 20:
-                        status = "⚠️ Слишком много точек (>20)"
-                    elif len(full_coordinates) > 4:
-                        status = "⚠️ Слишком много точек (>4)"
-                    
-                    ws.cell(row=row_num, column=start_col).value = status
-                    ws.cell(row=row_num, column=start_col+1).value = f"{start_coords[0]:.6f},{start_coords[1]:.6f}"
-                    ws.cell(row=row_num, column=start_col+2).value = "; ".join(all_coords_str)
-                    ws.cell(row=row_num, column=start_col+3).value = len(addresses)
-                    ws.cell(row=row_num, column=start_col+4).value = route_type
-                    ws.cell(row=row_num, column=start_col+5).value = "Ошибка"
-                    
-                    print(f"⚠️ Ошибка расчета маршрута")
-                
-                processed += 1
-                
-                # ===== ОБНОВЛЕНИЕ ПРОГРЕССА =====
-                if processed % 2 == 0 or processed == total:
-                    try:
-                        progress_percent = int((processed / total) * 100)
-                        
-                        progress_text = (
-                            f"⏳ Обработка: {processed}/{total} ({progress_percent}%)\n"
-                            f"✅ Успешно: {successful}\n"
-                            f"❌ Ошибки: {errors}\n"
-                            f"⏭️ Пропущено: {skipped}\n"
-                        )
-                        
-                        if geocode_errors > 0:
-                            progress_text += f"📍 Геокодирование: {geocode_errors}\n"
-                        
-                        if route_errors > 0:
-                            progress_text += f"🛣️ Маршруты: {route_errors}\n"
-                        
-                        # Показываем текущий обрабатываемый город
-                        if processed < total and successful > 0:
-                            settlement = extract_settlement_from_address(start_point)
-                            if settlement:
-                                progress_text += f"📍 Текущий: {settlement[:30]}..."
-                        
-                        await progress_msg.edit_text(progress_text)
-                    except Exception as e:
-                        print(f"⚠️ Ошибка обновления прогресса: {e}")
-                        
-            except Exception as e:
-                print(f"❌ Критическая ошибка в строке {row_num}: {e}")
-                log_error(row_num, f"{start_point[:50]}...", "CRITICAL", str(e))
-                errors += 1
-                processed += 1
+        if cancelled:
+            title = f"⛔ Обработка отменена! Обработано строк: {stats['processed']} из {total}"
+        else:
+            title = "✅ Обработка завершена!"
         
         # ===== СОХРАНЕНИЕ КЭША =====
         save_geocode_cache(geocode_cache)
+        route_cache_stats = ROUTE_CACHE.stats()
+        print(f"📊 Кэш маршрутов: попаданий {route_cache_stats['hits']}, "
+              f"промахов {route_cache_stats['misses']} ({route_cache_stats['hit_rate']}%)")
         
         # ===== СОХРАНЕНИЕ И ОТПРАВКА РЕЗУЛЬТАТА =====
         try:
             await progress_msg.edit_text(
-                f"✅ Обработка завершена!\n"
+                f"{title}\n"
                 f"📊 Итоги:\n"
                 f"• Всего строк: {total}\n"
-                f"• Успешно: {successful}\n"
-                f"• Ошибок: {errors}\n"
-                f"• Пропущено: {skipped}\n"
-                f"  └ Геокодирование: {geocode_errors}\n"
-                f"  └ Расчет маршрутов: {route_errors}\n\n"
+                f"• Уникальных адресов: {len(unique_addresses)}\n"
+                f"• Успешно: {stats['successful']}\n"
+                f"• Ошибок: {stats['errors']}\n"
+                f"• Пропущено: {stats['skipped']}\n"
+                f"  └ Геокодирование: {stats['geocode_errors']}\n"
+                f"  └ Расчет маршрутов: {stats['route_errors']}\n"
+                f"  └ Превышено время: {stats['timeouts']}\n\n"
                 f"💾 Сохраняю результаты..."
             )
         except:
@@ -1542,12 +3441,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             with open(output_file, "rb") as file:
                 caption = (
-                    f"✅ Обработка завершена!\n\n"
+                    f"{title}\n\n"
                     f"📊 **Статистика:**\n"
                     f"• Всего строк: {total}\n"
-                    f"• Успешно: {successful}\n"
-                    f"• Ошибок: {errors}\n"
-                    f"• Пропущено: {skipped}\n\n"
+                    f"• Успешно: {stats['successful']}\n"
+                    f"• Ошибок: {stats['errors']}\n"
+                    f"• Пропущено: {stats['skipped']}\n\n"
                     f"⚡ **Использовано:**\n"
                     f"• GraphHopper API\n"
                     f"• Яндекс.Геокодер\n"
@@ -1561,7 +3460,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"📎 Файл: {file_name}"
                 )
                 
-                await update.message.reply_document(
+                await message.reply_document(
                     document=file,
                     filename=f"результаты_{file_name}",
                     caption=caption,
@@ -1571,7 +3470,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             print(f"✅ Файл отправлен пользователю {user_id}")
             
         except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка отправки файла: {str(e)[:200]}")
+            await message.reply_text(f"❌ Ошибка отправки файла: {str(e)[:200]}")
         
         # ===== ОЧИСТКА =====
         try:
@@ -1584,11 +3483,11 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         error_msg = str(e)[:500]
-        await update.message.reply_text(f"❌ Критическая ошибка: {error_msg}\n\n"
-                                       "Пожалуйста, попробуйте:\n"
-                                       "1. Сохранить файл как .xlsx в Excel\n"
-                                       "2. Проверить, что файл не поврежден\n"
-                                       "3. Отправить файл заново")
+        await message.reply_text(f"❌ Критическая ошибка: {error_msg}\n\n"
+                                "Пожалуйста, попробуйте:\n"
+                                "1. Сохранить файл как .xlsx в Excel\n"
+                                "2. Проверить, что файл не поврежден\n"
+                                "3. Отправить файл заново")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
@@ -1597,6 +3496,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 /start - Начало работы
 /help - Эта справка
+/cancel - Остановить обработку своего файла (готовые строки будут отправлены)
 
 📁 **Формат Excel файла:**
 
@@ -1633,11 +3533,40 @@ B1: Ярославская обл., г. Ростов Великий - г. Яро
 """
     await update.message.reply_text(help_text)
 
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /cancel: отменяет файлы пользователя в работе и в очереди"""
+    user_id = update.message.from_user.id
+    running, removed = await JOB_QUEUE.cancel(user_id)
+    
+    if not running and not removed:
+        await update.message.reply_text("ℹ️ У вас нет файлов в обработке")
+        return
+    
+    lines = ["⛔ Отмена принята"]
+    if running:
+        lines.append(f"• Останавливаю обработку файлов: {running} (готовые строки будут отправлены)")
+    if removed:
+        lines.append(f"• Убрано из очереди: {removed}")
+    await update.message.reply_text("\n".join(lines))
+
 async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для проверки работы бота"""
     api_status = "✅ Доступен" if GRAPHHOPPER_API_KEY else "❌ Не настроен"
     yandex_status = "✅ Настроен" if YANDEX_GEOCODER_API_KEY else "❌ Не настроен"
     ors_status = "✅ Настроен" if ORS_API_KEY else "❌ Не настроен"
+    geocode_cache_stats = GEOCODE_CACHE.stats()
+    route_cache_stats = ROUTE_CACHE.stats()
+    breakers_status = "\n".join(
+        f"• {provider}: {breaker.status()}; {PROVIDER_LIMITERS[provider].status()}; "
+        f"{PROVIDER_LATENCY.status(provider)}"
+        for provider, breaker in PROVIDER_BREAKERS.items()
+    )
+    pipelines_status = "\n".join(f"• {pipeline.status()}" for pipeline in ACTIVE_PIPELINES) or "• нет активных"
+    keys_status = "\n".join(f"• {provider}: {pool.status()}" for provider, pool in API_KEY_POOLS.items())
+    flights_status = f"геокодирование {GEOCODE_FLIGHTS.shared}, маршруты {ROUTE_FLIGHTS.shared}"
+    connections_status = "\n".join(
+        f"• {provider}: {stats.status()}" for provider, stats in PROVIDER_CONNECTIONS.items()
+    )
     
     await update.message.reply_text(
         f"🤖 Бот работает!\n\n"
@@ -1645,6 +3574,18 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"GraphHopper API: {api_status}\n"
         f"Яндекс.Геокодер: {yandex_status}\n"
         f"OpenRouteService: {ors_status}\n\n"
+        f"🔌 Состояние провайдеров:\n{breakers_status}\n\n"
+        f"👷 Очередь файлов: {JOB_QUEUE.status()}\n"
+        f"🏭 Конвейеры:\n{pipelines_status}\n\n"
+        f"🔑 Ключи API:\n{keys_status}\n\n"
+        f"🔗 Соединения:\n{connections_status}\n"
+        f"🔁 Объединено одинаковых запросов: {flights_status}\n\n"
+        f"🗂️ Кэш геокодирования: {geocode_cache_stats['entries']} записей, "
+        f"попаданий {geocode_cache_stats['hits']}, промахов {geocode_cache_stats['misses']} "
+        f"({geocode_cache_stats['hit_rate']}%), ненайденных адресов {len(GEOCODE_MISSES)}\n"
+        f"🗂️ Кэш маршрутов: {route_cache_stats['entries']} записей, "
+        f"попаданий {route_cache_stats['hits']}, промахов {route_cache_stats['misses']} "
+        f"({route_cache_stats['hit_rate']}%), шаг сетки координат {ROUTE_CACHE_SNAP_METERS:g} м\n\n"
         f"⚠️ Для получения Яндекс.Геокодер API ключа:\n"
         f"1. Зарегистрируйтесь на https://developer.tech.yandex.ru/\n"
         f"2. Получите API ключ для Яндекс.Геокодера\n"
@@ -1664,21 +3605,28 @@ async def run_bot():
         return
     
     print(f"✅ Токен получен")
-    print(f"✅ GraphHopper API ключ: {'✅ Настроен' if GRAPHHOPPER_API_KEY else '❌ Не настроен'}")
+    print(f"✅ GraphHopper API ключ: {'✅ Настроен' if GRAPHHOPPER_API_KEY else '❌ Не настроен'} (ключей: {len(GRAPHHOPPER_API_KEYS)})")
     print(f"✅ Яндекс.Геокодер API ключ: {'✅ Настроен' if YANDEX_GEOCODER_API_KEY else '❌ Не настроен'}")
-    print(f"✅ OpenRouteService API ключ: {'✅ Настроен' if ORS_API_KEY else '❌ Не настроен'}")
+    print(f"✅ OpenRouteService API ключ: {'✅ Настроен' if ORS_API_KEY else '❌ Не настроен'} (ключей: {len(ORS_API_KEYS)})")
     
     if not GRAPHHOPPER_API_KEY:
         print("⚠️ ВНИМАНИЕ: GraphHopper API ключ не установлен!")
         print("Добавьте переменную GRAPHHOPPER_API_KEY в Render")
     
+    # Открываем базу кэшей (и переносим в нее старые JSON-файлы)
+    get_cache_store()
+    # Счетчики ключей за прошедшие сутки больше не нужны
+    API_KEY_USAGE.purge()
+    
     # Создаем приложение
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Обновления обрабатываются параллельно: загрузка файла одного пользователя не задерживает остальных
+    application = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True).build()
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("test", test_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     
     # Пытаемся запустить бота
@@ -1702,6 +3650,9 @@ async def run_bot():
                 poll_interval=0.5
             )
             
+            # Воркеры обработки файлов
+            JOB_QUEUE.start()
+            
             print("🤖 Бот работает и ожидает сообщений...")
             print("ℹ️ Для остановки нажмите Ctrl+C")
             
@@ -1716,6 +3667,7 @@ async def run_bot():
             try:
                 await application.stop()
                 await application.shutdown()
+                await close_http_client()
             except:
                 pass
             